@@ -17,13 +17,14 @@ Enjoy--
 """
 from pytrios import PyTrios as ps
 from pytrios import ramses_calibrate as rcal
+from pytrios import spectralog
 #from pytrios import gpslib
 import sys
 import time
 import datetime
 import argparse
 import serial
-from numpy import arange, nan, isnan
+from numpy import arange, nan, isnan, float32
 import matplotlib.pyplot as plt
 # force mathtext to use sans serif
 plt.rcParams['mathtext.fontset'] = 'stixsans'
@@ -53,6 +54,22 @@ class TriosManager(object):
                 sys.exit(1)
         else:
             self.calibrate = False
+        self.wlOut = arange(320, 955, 3.3)
+        if self.calibrate:
+            # calibration arrays are prepared once, not for every spectrum
+            self.calibrator = rcal.Calibrator(self.caldict, self.wlOut)
+
+        # spectra are written on background threads, so a slow disk
+        # does not delay the next trigger
+        self.rawwriter, self.calwriter = None, None
+        if self.args.rawout is not None:
+            self.rawwriter = spectralog.AsyncSpectraWriter(
+                self.args.rawout, fmt=self.args.outformat)
+        if self.calibrate and self.args.calout is not None:
+            self.calwriter = spectralog.AsyncSpectraWriter(
+                self.args.calout, fmt=self.args.outformat,
+                width=len(self.wlOut), dtype=float32,
+                wavelengths=self.wlOut)
 
         # coms = []
         # # connect and start listening on specified COM port(s)
@@ -100,7 +117,6 @@ class TriosManager(object):
                 counter += 1
                 for s in self.sams:
                     lasttrigger = datetime.datetime.now()
-                    lasttrigstr = lasttrigger.isoformat()
 
                     if self.args.inttime > 0:
                         for com in self.coms:
@@ -157,23 +173,18 @@ class TriosManager(object):
                     itimes = [self.tc[s].TSAM.lastIntTime
                             for s in self.sams if self.tc[s].is_finished()]
 
-                    if self.args.rawout is not None:
-                        #  write raw data to specified file
+                    if self.rawwriter is not None:
+                        #  queue raw data for the specified file
                         for sp, si, it in zip(specs, sids, itimes):
-                            outstr = ",".join([lasttrigstr,
-                                            si, str(it),
-                                            ",".join([str(s) for s in sp])])+'\n'
-                            with open(self.args.rawout, 'a+') as f:
-                                f.write(outstr)
+                            self.rawwriter.put(sp, lasttrigger, si, it)
 
                     if self.calibrate:  # get calibrated spectra
                         cspecs = []
-                        wlOut = arange(320, 955, 3.3)
+                        wlOut = self.wlOut
                         for spec, sid in zip(specs, sids):
                             try:
-                                csp = rcal.raw2cal_Air(spec, lasttrigger,
-                                                    sid, caldict,
-                                                    wlOut=wlOut)
+                                csp = self.calibrator.calibrate(
+                                    spec, lasttrigger, sid)
                                 cspecs.append(csp)
                             except:
                                 warnmsg = "Could not calibrate spectrum from {0}. Is calibration file present?".format(sid)
@@ -181,16 +192,11 @@ class TriosManager(object):
                                 print(warnmsg, file=sys.stderr)
                                 pass
 
-                    if self.calibrate and self.args.calout is not None:
-                        #  write calibrated data to specified file
+                    if self.calwriter is not None:
+                        #  queue calibrated data for the specified file
                         for sp, si, it in zip(cspecs, sids, itimes):
                             if sum([1 for s in sp if isnan(s)]) < len(sp):
-                                outstr = ",".join([lasttrigstr,
-                                                si, str(it),
-                                                ",".join([str(s) for s in sp])])
-                                outstr = outstr + '\n'
-                                with open(self.args.calout, 'a+') as f:
-                                    f.write(outstr)
+                                self.calwriter.put(sp, lasttrigger, si, it)
 
                     if self.args.plotting:
                         # plot results
@@ -215,6 +221,7 @@ class TriosManager(object):
                     go = False
             except:
                 ps.TClose(self.coms)
+                self.close_writers()
 
                 print("unexpected error!")
                 raise
@@ -224,10 +231,17 @@ class TriosManager(object):
         # input('Press enter to close')
         # sys.exit(0)
         time.sleep(0.02)
+        self.close_writers()
 
+    def close_writers(self):
+        """write out queued spectra and close the output files"""
+        for writer in [self.rawwriter, self.calwriter]:
+            if writer is not None:
+                writer.close()
 
     def __del__(self):
         ps.TClose(self.coms)
+        self.close_writers()
 
 
 
@@ -249,6 +263,10 @@ def parse_arguments():
                         help="raw data output file")
     parser.add_argument("-calout", type=str,
                         help="calibrated data output file")
+    parser.add_argument("-outformat", type=str, default='csv',
+                        choices=['csv', 'npy'],
+                        help="output file format, text (csv) or binary "
+                        "spectra log (npy)")
     parser.add_argument("-calpath", type=str,
                         help="path to search for calibration files")
     parser.add_argument("-inttime", type=int, default=0,
@@ -28,11 +28,18 @@ Last update: see __version__\n
 
 import sys
 import time
+import queue
+import datetime
 import struct
+import select
+import selectors
+import asyncio
+import serial
 import numpy as np
 import threading
 from .TClasses import TProtocolError, TPackMeasKeyError,\
-    TPacket, TSerial, TCommandSend
+    TPacket, TSerial, TCommandSend, TCommandSendBatch,\
+    TDecoder, TListenStats, TIMEOUT_SAM
 
 __version__ = "2015.12.28"
 __author__ = "Stefan Simis"
@@ -62,10 +69,8 @@ def handlePacket(ser, packet):
                              command='query_sam')
 
     if p.packetType == 'query' and p.tchannel.TInfo.ModuleType == 'MicroFlu':
-        ch = p.tchannel
-        ch.serial = ser
         port_tid = ser.port + '_' + p.TID
-        tchannels[port_tid] = ch
+        ch = _register_channel(ser, port_tid, p.tchannel)
         # Follow microflu query by ROM Config request for full sensor info
         TCommandSend(ser, commandset='MicroFlu',
                      ipschan=ch.TInfo.TID[0:2],
@@ -96,10 +101,8 @@ def handlePacket(ser, packet):
 
     if p.packetType == 'query' and\
             p.tchannel.TInfo.ModuleType in ['SAMIP', 'SAM']:
-        ch = p.tchannel
-        ch.serial = ser
         port_tid = ser.port + '_' + p.TID
-        tchannels[port_tid] = ch
+        _register_channel(ser, port_tid, p.tchannel)
 
     if p.packetType == 'measurement':
         if int(p.tid3) in [20, 30]:
@@ -141,69 +144,79 @@ def handlePacket(ser, packet):
             raise TProtocolError(emsg)
 
 
+def _register_channel(ser, port_tid, ch):
+    """Add queried channel *ch* to tchannels. A channel that is queried
+    again keeps its identity (and registered callbacks/waiters), only its
+    instrument info and settings are updated."""
+    global tchannels
+    known = tchannels.get(port_tid)
+    if known is None:
+        ch.serial = ser
+        tchannels[port_tid] = ch
+        return ch
+    known.serial = ser
+    known.TInfo = ch.TInfo
+    known.TSAM.Settings = ch.TSAM.Settings
+    known.TMicroFlu.Settings = ch.TMicroFlu.Settings
+    return known
+
+
 def SAMInterpreter(regch, packet):
-    formatstring = '<'+'H'*int(packet.id1_databytes/2)
-    rawdata = bytearray(y for y in packet.databytes)
-    LEdata = struct.unpack(formatstring, rawdata)
-    """ sloppy code comment:
-    In the following, if we place LEdata directly into the dataframes slice
-    it will be overwritten upon prompt arrival of a new packet, even if this
-    concerns a different entry of the tchannels dictionary. Odd!
-    Reading and writing back the list of dataframes first circumvents this.
-    Packets arriving in rapid succession re-use memory blocks. So this
-    possibly points to sloppy garbage collection?
-    """
-    dataframes = regch.TSAM.dataframes[:]
-    dataframes[packet.framebyte] = LEdata
-    regch.TSAM.dataframes = dataframes
+    sam = regch.TSAM
+    if packet.id1_databytes != 2*sam.framebuffer.shape[1]\
+            or packet.framebyte >= sam.framebuffer.shape[0]:
+        emsg = "SAM Interpreter: unexpected frame {0} ({1} bytes)"\
+            .format(packet.framebyte, packet.id1_databytes)
+        raise TProtocolError(emsg)
+    # write little endian pixel values straight into the frame buffer
+    sam.framebuffer[packet.framebyte] = np.frombuffer(packet.databuffer,
+                                                      dtype='<u2')
+    sam.framemask |= 1 << packet.framebyte
     if regch.verbosity >= 4:
         print("SAMInterpreter: Spectrum framebyte {0} from {1} at {2}/{3}"
               .format(packet.framebyte, regch.TInfo.serialn,
                       regch.serial.port, regch.TInfo.TID),
               file=sys.stdout)
     if packet.framebyte == 0:
-        frames = regch.TSAM.dataframes
-        if sum(y is None for y in frames) == 0:
-            outspec = []
-            for sublist in frames:
-                sl = list(sublist)
-                sl.reverse()
-                outspec = outspec+sl
-            outspec.reverse()  # assuming this is not a UV sensor..
-            regch.TSAM.lastRawSAM = outspec
-            regch.TSAM.lastRawSAMTime = packet.timeStampPC
-            msintt = 2*2**(outspec[0] & 0b1111)  # integration time
-            regch.TSAM.lastIntTime = msintt
-            # reset to receive the next spectrum
-            regch.TSAM.dataframes = [[None]]*8
+        complete = sam.framemask == 0xFF
+        sam.framemask = 0  # reset to receive the next spectrum
+        if complete:
+            # frames arrive as 7..0, pixel order runs from frame 7 to 0
+            # (assuming this is not a UV sensor..)
+            outspec = sam.framebuffer[::-1].flatten()
+            msintt = 2*2**(int(outspec[0]) & 0b1111)  # integration time
+            sam.lastRawSAMArray = outspec
+            sam.lastRawSAMTime = packet.timeStampPC
+            sam.lastIntTime = msintt
+            if sam.history is not None:
+                sam.history.append(outspec, packet.timeStampPC.timestamp(),
+                                   msintt)
             if regch.verbosity >= 2:
                 delay = packet.timeStampPC - regch.lasttrigger
                 print("SAMInterpreter: Spectrum ({3}ms) from {0}, {1} ({2} s)"
                       .format(regch.TInfo.serialn, regch.TInfo.TID,
                               delay.total_seconds(), msintt),
                       file=sys.stdout)
+            regch._measurement_done(outspec, packet.timeStampPC, msintt)
         else:
             emsg = "SAM Interpreter: Incomplete spectrum, discarded"
             print(emsg, file=sys.stderr)
             raise TProtocolError(emsg)
-            # reset to receive the next spectrum
-            regch.TSAM.dataframes = [[None]]*8
     return regch
 
 
 def MFInterpreter(regch, packet):
     # byteorder is big endian although documentation suggests different
     formatstring = '>'+'H'*int(packet.id1_databytes/2)
-    BEdata = struct.unpack(formatstring,
-                           ''.join([chr(y) for y in packet.Databytes]))
+    BEdata = struct.unpack(formatstring, bytearray(packet.databytes))
     gain = BEdata[0] >> 15  # 0 = high gain, 1 = low gain
     data = BEdata[0] & 0b111111111111
     regch.TMicroFlu.lastFluRaw = [gain, data]
     regch.TMicroFlu.lastFluTime = packet.timeStampPC
     if gain == 1:
-        regch.TMicroFlu.lastFluCal = 100*data/np.float(2048)
+        regch.TMicroFlu.lastFluCal = 100*data/float(2048)
     if gain == 0:
-        regch.TMicroFlu.lastFluCal = 10*data/np.float(2048)
+        regch.TMicroFlu.lastFluCal = 10*data/float(2048)
         if regch.verbosity > 1:
             gains = ['H', 'L']
             ftypes = [None, 'Chl', 'Blue', 'CDOM', 'unknown', 'Red']
@@ -214,11 +227,26 @@ def MFInterpreter(regch, packet):
                       .format(ftype, regch.serial.port, regch.TInfo.TID,
                               gains[gain], data,
                               regch.TMicroFlu.lastFluCal), file=sys.stdout)
+    if regch.TMicroFlu.history is not None:
+        regch.TMicroFlu.history.append(
+            (gain, data, regch.TMicroFlu.lastFluCal),
+            packet.timeStampPC.timestamp())
+    regch._measurement_done(regch.TMicroFlu.lastFluCal,
+                            packet.timeStampPC)
     return regch
 
 
-def TMonitor(ports, baudrate=9600):
-    """Initiate serial port listening threads. Start here."""
+def TMonitor(ports, baudrate=9600, mode='poll', loop=None):
+    """Initiate serial port listening threads. Start here.\n
+    *mode* = 'poll' checks the ports at a fixed 20 ms cycle,
+    'event' blocks until data arrives at a port and then drains it,
+    'reactor' services all ports from a single selector-based thread,
+    'asyncio' registers all ports as readers on the asyncio event *loop*
+    (default: the current event loop), no threads are started.\n
+    Listener statistics are kept per port in *ser.listenstats*."""
+    listeners = {'poll': TListen, 'event': TListenEvent}
+    if mode not in listeners and mode not in ['reactor', 'asyncio']:
+        raise ValueError("TMonitor: unknown mode {0}".format(mode))
     try:
         if not type(ports) is list:
             ports = [ports]
@@ -227,19 +255,31 @@ def TMonitor(ports, baudrate=9600):
             ser = TSerial(p, timeout=0.01, baudrate=baudrate, xonxoff=True,
                           parity='N', stopbits=1, bytesize=8)
             if ser.isOpen():
-                # associated port listening thread
-                ser.threadlisten = threading.Thread(target=TListen,
-                                                    args=(ser,))
+                ser.decoder = TDecoder()  # incremental frame decoder
+                ser.listenstats = TListenStats()
                 ser.threadlive = threading.Event()   # clear to stop thread
                 ser.threadactive = threading.Event()  # clear to pause thread
                 ser.threadlive.set()
                 ser.threadactive.set()
                 COMobjslst.append(ser)
-                ser.threadlisten.start()  # start thread
-                ser.threadlisten.join(0.01)  # join calling thread
+                if mode in listeners:
+                    # associated port listening thread
+                    ser.threadlisten = threading.Thread(
+                        target=listeners[mode], args=(ser,))
+                    ser.threadlisten.start()  # start thread
+                    ser.threadlisten.join(0.01)  # join calling thread
         if sum([1 for c in COMobjslst if c.isOpen()]) == 0:
             raise ValueError("TMonitor: no COM ports to watch")
             sys.exit(1)
+        if mode == 'reactor':
+            # one listening thread shared by all ports
+            reactor = threading.Thread(target=TListenReactor,
+                                       args=(COMobjslst,))
+            for ser in COMobjslst:
+                ser.threadlisten = reactor
+            reactor.start()
+        elif mode == 'asyncio':
+            TListenAsync(COMobjslst, loop=loop)
         return COMobjslst
     except:
         TClose(COMobjslst)
@@ -247,83 +287,402 @@ def TMonitor(ports, baudrate=9600):
         raise
 
 
-def _get_s2parse(s, ser):
-    "extract data blocks from serial buffer"
+def _init_listener(ser):
+    "attach decoder and statistics to ports not opened through TMonitor"
+    if not hasattr(ser, 'decoder'):
+        ser.decoder = TDecoder()
+    if not hasattr(ser, 'listenstats'):
+        ser.listenstats = TListenStats()
+
+
+def _dispatch(ser, data, wakeup, since=None, logerrors=False):
+    """decode raw bytes read at time *wakeup* and handle all complete blocks.
+    *since* = earliest time the data can have arrived (defaults to
+    *wakeup*), see TListenStats.
+    With *logerrors* a block that cannot be handled is reported and the
+    remaining blocks are still handled, otherwise the Warning is raised."""
+    if since is None:
+        since = wakeup
+    latencies, processing = [], []
+    for s2parse in ser.decoder.feed(data):
+        if ser.verbosity >= 4:
+            prettyhex = ":".join("{0:x}".format(c) for c in s2parse)
+            print("TListen: {0}".format(prettyhex), file=sys.stdout)
+        try:
+            _handle_s2parse(ser, s2parse)
+        except Warning as msg:
+            if not logerrors:
+                raise
+            if ser.verbosity >= 1:
+                print("TListen: packet on port {0} not handled: {1}"
+                      .format(ser.port, msg), file=sys.stderr)
+        now = time.time()
+        latencies.append(now - since)
+        processing.append(now - wakeup)
+    ser.listenstats.record(len(data), latencies, processing)
+
+
+def _read_blocking(ser, fd, timeout):
+    """wait up to *timeout* s for data on *ser*, return (everything
+    available, True if no data was waiting when called)"""
+    if fd is not None:
+        ready, _, _ = select.select([fd], [], [], 0)
+        waited = not ready
+        if waited:
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                return b'', waited
+        return ser.read(max(ser.inWaiting(), 1)), waited
+    # no selectable file descriptor (e.g. Windows): blocking read instead
+    waited = ser.inWaiting() == 0
+    data = ser.read(1)
+    if data:
+        data += ser.read(ser.inWaiting())
+    return data, waited
+
+
+def _handle_s2parse(ser, s2parse):
+    "interpret a single data block and pass it on to handlePacket"
     try:
-        bitsatport = ser.inWaiting()
-        if max([bitsatport, len(s)]) < 1:
-            return s, None
-
-        s = s+ser.read(1000)
-        first, last = s.find(b'#'), s.rfind(b'#')
-        s = TStrRepl(s)  # correct replacement chars
-        if first < 0 or not last >= first:
-            return s, None
-
-        s = s[s.find(b'#', 0):]  # omit incomplete sequence at start
-        if len(s) <= 1:  # 1st byte after # = size
-            return s, None
-
-        ndatabytes = 2*2**(s[1] >> 5)
-        blocklength = 8+ndatabytes
-        if len(s) >= blocklength:
-            s2parse = s[1:blocklength]  # block to parse
-            if ser.verbosity >= 4:
-                prettyhex = ":".join("{0:x}".format(c) for c in s2parse)
-                print("TListen: {0}".format(prettyhex), file=sys.stdout)
-            s = s[blocklength:]  # remainder to next cycle
-            return s, s2parse
+        packet = TPacket(s2parse)
+        if packet is None:
+            if ser.verbosity >= 1:
+                print("TListen: bad packet on port {0}"
+                      .format(ser.port), file=sys.stderr)
         else:
-            return s, None
-    except TProtocolError as e:
-        print("{0} {1}".format(e.message, ser.port), file=sys.stderr)
-        pass
-    except Exception:
-        raise
+            handlePacket(ser, packet)
+    except TProtocolError as msg:
+        raise Warning(msg)
+    except TPackMeasKeyError as msg:
+        raise Warning(msg)
+    except Exception as msg:
+        raise Warning(msg)
 
 
 def TListen(ser):
     """Monitors and maintains a serial port instance *ser*"""
     print("Start listening thread on {0}".format(ser.port), file=sys.stdout)
-    s = b""
-    timeouttimer = 0
+    _init_listener(ser)
+    cpu0 = time.thread_time()
     while ser.threadlive.isSet():
+        lastpoll = time.time()
         while ser.threadactive.isSet():
-            s, s2parse = _get_s2parse(s, ser)
-            if s2parse is not None:
-                timeouttimer = 0     # reset timeout
-                try:
-                    packet = TPacket(s2parse)
-                    if packet is None:
-                        if ser.verbosity >= 1:
-                            print("TListen: bad packet on port {0}"
-                                  .format(ser.port), file=sys.stderr)
-                    else:
-                        handlePacket(ser, packet)
-                except TProtocolError as msg:
-                    raise Warning(msg)
-                except TPackMeasKeyError as msg:
-                    raise Warning(msg)
-                    if ser.isOpen:
-                        ser.flushOutput()
-                        ser.flushInput()
-                        s = ''
-                        # resend query?
-                    else:
-                        raise Exception('Unrecoverable error - reboot sensors')
-                        sys.exit(1)
-                except Exception as msg:
-                    raise Warning(msg)
-            elif timeouttimer - time.time() > 1:
-                s = ""  # clear the buffer
-                emsg = "Timeout while parsing buffer"
-                raise Warning(emsg)
-            elif timeouttimer == 0:  # set a new timer
-                timeouttimer = time.time()
+            bitsatport = ser.inWaiting()
+            wakeup = time.time()
+            if bitsatport > 0:
+                # arrived at some point since the previous poll
+                _dispatch(ser, ser.read(bitsatport), wakeup, lastpoll)
+            lastpoll = wakeup
+            ser.listenstats.cputime = time.thread_time() - cpu0
             time.sleep(0.02)  # pace this cycle
         time.sleep(0.1)  # check threadactive periodically to resume
 
 
+def TListenEvent(ser, timeout=0.5):
+    """Monitors a serial port instance *ser*, sleeping until data arrives.\n
+    Every wakeup drains all bytes waiting at the port. *timeout* only sets
+    how often the thread checks whether it should pause or stop."""
+    print("Start event listening thread on {0}".format(ser.port),
+          file=sys.stdout)
+    _init_listener(ser)
+    try:
+        fd = ser.fileno()
+    except Exception:
+        fd = None
+        ser.timeout = timeout
+    cpu0 = time.thread_time()
+    lastread = time.time()
+    while ser.threadlive.isSet():
+        if not ser.threadactive.isSet():
+            time.sleep(0.1)  # check threadactive periodically to resume
+            lastread = time.time()
+            continue
+        try:
+            data, waited = _read_blocking(ser, fd, timeout)
+        except (OSError, TypeError, ValueError, serial.SerialException):
+            if not ser.threadlive.isSet():
+                break  # port closed by TClose while waiting
+            raise
+        wakeup = time.time()
+        if data:
+            # data that woke the thread arrived just now, data already
+            # waiting arrived at some point since the previous read
+            _dispatch(ser, data, wakeup, None if waited else lastread)
+        lastread = wakeup
+        ser.listenstats.cputime = time.thread_time() - cpu0
+
+
+def _reactor_sync(sel, sers, registered, failed=()):
+    """(un)register ports with selector *sel* according to their thread
+    flags, ports in *failed* are never registered again"""
+    for i, ser in enumerate(sers):
+        want = ser.threadlive.isSet() and ser.threadactive.isSet() and\
+            i not in failed
+        if want and i not in registered:
+            registered[i] = ser.fileno()
+            sel.register(registered[i], selectors.EVENT_READ, (i, ser))
+        elif i in registered and not want:
+            sel.unregister(registered.pop(i))
+
+
+def TListenReactor(sers, timeout=0.5):
+    """Monitors all serial port instances *sers* from a single thread.\n
+    Ports are drained in the order given, so packets that arrive within
+    the same wakeup are always handled in the same port order. Requires
+    selectable ports (not available on Windows). The thread CPU time is
+    reported in the *listenstats* of every port.\n
+    Packets that cannot be handled are reported (verbosity >= 1) and do
+    not stop the thread. A port that fails to read is dropped, the other
+    ports are still monitored."""
+    print("Start reactor listening thread on {0}"
+          .format(", ".join(ser.port for ser in sers)), file=sys.stdout)
+    sel = selectors.DefaultSelector()
+    registered = {}  # port index: file descriptor
+    failed = set()  # indices of ports that could not be read
+    for ser in sers:
+        _init_listener(ser)
+    cpu0 = time.thread_time()
+    lastcycle = time.time()
+    while any(ser.threadlive.isSet() for ser in sers):
+        try:
+            _reactor_sync(sel, sers, registered, failed)
+            paused = any(not ser.threadactive.isSet() for ser in sers)
+            # data already waiting arrived at some point since the
+            # previous cycle, data that wakes the thread arrives just now
+            events = sel.select(0)
+            since = lastcycle if events else None
+            if not events:
+                events = sel.select(0.1 if paused else timeout)
+        except (OSError, TypeError, ValueError, serial.SerialException):
+            if not all(ser.threadlive.isSet() for ser in sers):
+                # port closed by TClose, drop it from the selector
+                sel.close()
+                sel = selectors.DefaultSelector()
+                registered = {}
+                continue
+            raise
+        wakeup = time.time()
+        lastcycle = wakeup
+        for key, _ in sorted(events, key=lambda ev: ev[0].data[0]):
+            i, ser = key.data
+            if not ser.threadlive.isSet():
+                continue
+            try:
+                data = ser.read(max(ser.inWaiting(), 1))
+            except (OSError, TypeError, ValueError, serial.SerialException)\
+                    as msg:
+                if ser.threadlive.isSet():  # not closed by TClose
+                    failed.add(i)
+                    if ser.verbosity >= 1:
+                        print("TListenReactor: stopped reading port {0}: {1}"
+                              .format(ser.port, msg), file=sys.stderr)
+                if i in registered:
+                    try:
+                        sel.unregister(registered.pop(i))
+                    except (KeyError, ValueError, OSError):
+                        pass
+                continue
+            if data:
+                _dispatch(ser, data, wakeup, since, logerrors=True)
+        cputime = time.thread_time() - cpu0
+        for ser in sers:
+            ser.listenstats.cputime = cputime
+    sel.close()
+
+
+def _async_read(loop, ser):
+    "asyncio reader callback, drains and handles data waiting at *ser*"
+    fd = ser.asyncfd
+    if not ser.threadlive.isSet():
+        loop.remove_reader(fd)
+        return
+    if not ser.threadactive.isSet():
+        # stop watching while paused, check again periodically to resume
+        loop.remove_reader(fd)
+        loop.call_later(0.1, _async_resume, loop, ser)
+        return
+    wakeup = time.time()
+    data = ser.read(max(ser.inWaiting(), 1))
+    if data:
+        _dispatch(ser, data, wakeup)
+
+
+def _async_resume(loop, ser):
+    if not ser.threadlive.isSet():
+        return
+    if ser.threadactive.isSet():
+        loop.add_reader(ser.asyncfd, _async_read, loop, ser)
+    else:
+        loop.call_later(0.1, _async_resume, loop, ser)
+
+
+def TListenAsync(sers, loop=None):
+    """Monitors serial port instances *sers* from an asyncio event *loop*.\n
+    Packets are handled on the event loop thread. Requires selectable
+    ports (not available on Windows)."""
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    for ser in sers:
+        _init_listener(ser)
+        ser.asyncloop = loop
+        ser.asyncfd = ser.fileno()
+        loop.add_reader(ser.asyncfd, _async_read, loop, ser)
+        print("Start asyncio listening on {0}".format(ser.port),
+              file=sys.stdout)
+
+
+async def TMeasureAll(channels, inttime=0, timeout=None):
+    """Trigger all *channels* at once and await their measurements.\n
+    *channels* = list of TChannel instances or a dict such as tchannels\n
+    Returns results in the order of *channels*, None where a channel timed
+    out. Use with asyncio.gather to interleave with other tasks."""
+    if isinstance(channels, dict):
+        channels = list(channels.values())
+    results = await asyncio.gather(*[ch.measure(inttime=inttime,
+                                                timeout=timeout)
+                                     for ch in channels],
+                                   return_exceptions=True)
+    out = []
+    for r in results:
+        if isinstance(r, asyncio.TimeoutError):
+            out.append(None)
+        elif isinstance(r, Exception):
+            raise r
+        else:
+            out.append(r)
+    return out
+
+
+class TScheduler(object):
+    """Re-triggers SAM channels independently as soon as their spectrum
+    arrives, instead of waiting for the slowest sensor every round.\n
+    *channels* = list (or dict such as tchannels) of SAM TChannels\n
+    *inttime* = integration time in ms (0 = autorange)\n
+    *groups* = lists of channels to keep phase-aligned, e.g. an Rrs
+    triplet [Ed, Lu, Lsky]. Members of a group are triggered together
+    and re-triggered once all of them have reported.\n
+    *tolerance* = seconds to wait for the remaining members of a group
+    once the first member reported. The whole group is re-triggered when
+    it expires, measurements still outstanding are counted as missed.
+    None waits up to TIMEOUT_SAM.\n
+    *callback* = called as callback(channel, time, spectrum, inttime) on
+    the scheduler thread for every spectrum received.\n
+    *spectra*, *missed* = counts per channel, keyed as tchannels
+    (port_TID)\n
+    *stale* = spectra per channel received after their group was
+    re-triggered (not later than the current trigger), these are not
+    passed to *callback* nor counted towards the current round\n"""
+    def __init__(self, channels, inttime=0, groups=None, tolerance=None,
+                 callback=None):
+        if isinstance(channels, dict):
+            # TIDs repeat across ports, keep the port_TID keys
+            self.names = dict((id(ch), k) for k, ch in channels.items())
+            channels = list(channels.values())
+        else:
+            self.names = {}
+        self.inttime = inttime
+        self.tolerance = tolerance
+        self.callback = callback
+        grouped = [ch for g in (groups or []) for ch in g]
+        self.units = [list(g) for g in (groups or [])] +\
+            [[ch] for ch in channels if ch not in grouped]
+        if not self.units:
+            raise ValueError("TScheduler needs at least one channel")
+        self.spectra = dict((self._name(ch), 0)
+                            for u in self.units for ch in u)
+        self.missed = dict(self.spectra)
+        self.stale = dict(self.spectra)
+        self.events = queue.Queue()
+        self.thread = None
+        self.live = threading.Event()
+
+    def _name(self, ch):
+        """counter key of a channel, port_TID as in tchannels"""
+        if id(ch) not in self.names:
+            port = ch.serial.port if ch.serial is not None else None
+            self.names[id(ch)] = "{0}_{1}".format(port, ch.TInfo.TID)
+        return self.names[id(ch)]
+
+    def _on_spectrum(self, ch, data):
+        # listening thread: hand over to the scheduler thread
+        self.events.put((ch, ch.TSAM.lastRawSAMTime, data,
+                         ch.TSAM.lastIntTime))
+
+    def _trigger(self, unit, state):
+        trigger = datetime.datetime.now()
+        batches = {}  # one write per serial port
+        for ch in unit:
+            if ch not in state['done']:
+                self.missed[self._name(ch)] += state['triggered']
+            ch._set_trigger('measurement', trigger)
+            batches.setdefault(id(ch.serial), (ch.serial, []))[1]\
+                .append(ch._measure_command(self.inttime))
+        for ser, commands in batches.values():
+            TCommandSendBatch(ser, commands)
+        now = time.time()
+        state.update(done=set(), triggered=1, deadline=now + TIMEOUT_SAM,
+                     trigger=trigger)
+
+    def run(self):
+        """scheduler loop, normally started in a thread by start()"""
+        states = [dict(done=set(), triggered=0) for u in self.units]
+        unitof = {}
+        for u, state in zip(self.units, states):
+            for ch in u:
+                unitof[id(ch)] = (u, state)
+            self._trigger(u, state)
+        while self.live.isSet():
+            wait = min(st['deadline'] for st in states) - time.time()
+            try:
+                ch, t, data, inttime = self.events.get(
+                    timeout=min(max(wait, 0), 0.5))
+            except queue.Empty:
+                now = time.time()
+                for u, state in zip(self.units, states):
+                    if now >= state['deadline']:
+                        self._trigger(u, state)  # timed out
+                continue
+            u, state = unitof[id(ch)]
+            if t is None or t <= state['trigger']:
+                # late spectrum of a previous round, the sensor has been
+                # re-triggered since
+                self.stale[self._name(ch)] += 1
+                continue
+            self.spectra[self._name(ch)] += 1
+            if self.callback is not None:
+                self.callback(ch, t, data, inttime)
+            state['done'].add(ch)
+            if len(state['done']) == len(u):
+                self._trigger(u, state)
+            elif len(state['done']) == 1 and self.tolerance is not None:
+                state['deadline'] = min(state['deadline'],
+                                        time.time() + self.tolerance)
+
+    def start(self):
+        """register with the channels and start the scheduler thread"""
+        for u in self.units:
+            for ch in u:
+                ch.on_spectrum(self._on_spectrum)
+        self.live.set()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def stop(self):
+        """stop re-triggering, measurements in progress are ignored"""
+        self.live.clear()
+        if self.thread is not None:
+            self.thread.join()
+        for u in self.units:
+            for ch in u:
+                ch.remove_callback(self._on_spectrum)
+
+    def __repr__(self):
+        msg = "<PyTrios TScheduler: {0} units, spectra {1}, missed {2}, "\
+            .format(len(self.units), self.spectra, self.missed)\
+            + "stale {0}>".format(self.stale)
+        return msg
+
+
 def TClose(COMs):
     errors = ''
     if not type(COMs) is list:
@@ -333,6 +692,9 @@ def TClose(COMs):
         try:
             c.threadactive.clear()
             c.threadlive.clear()
+            if hasattr(c, 'asyncloop') and not c.asyncloop.is_closed():
+                c.asyncloop.call_soon_threadsafe(c.asyncloop.remove_reader,
+                                                 c.asyncfd)
             c.close()
         except Exception:
             print("Error closing port {0}".format(c.port), file=sys.stderr)
@@ -11,15 +11,24 @@ from TClasses import TProtocolError, TPacket, TChannel
 """
 
 import sys
+import time
 import datetime
+import queue
+import asyncio
+import threading
 import struct
 import serial
 import numpy as np
 from serial import Serial
+from ._utils import put_drop_oldest
 
 # global definitions
 TIMEOUT_SAM = 12
 TIMEOUT_MF = 5
+# SAM integration time (ms) to command parameter, 0 = autorange
+INTTIMES = {0: '00', 8: '02', 16: '03', 32: '04', 64: '05',
+            128: '06', 256: '07', 512: '08', 1024: '09',
+            2048: '0A', 4096: '0B', 8192: '0C'}
 
 
 class TSerial(Serial):
@@ -58,6 +67,181 @@ class TPackMeasKeyError(Exception):
         return repr(self.value)
 
 
+class TDecoder(object):
+    """Streaming decoder for the TriOS serial protocol.\n
+    Raw bytes are fed in as they are read from the port. Escape sequences
+    (@d, @e, @f, @g) are resolved once per incoming byte and every complete
+    '#'-delimited frame is returned by a single call to *feed*.\n
+    *bytes_consumed* = raw bytes fed to the decoder\n
+    *frames_emitted* = complete frames returned\n
+    *resyncs* = incomplete or oversized frames discarded\n"""
+    escapes = {0x64: 0x40,   # @d: escape char @
+               0x65: 0x23,   # @e: data start #
+               0x66: 0x11,   # @f: xOn
+               0x67: 0x13}   # @g: xOff
+
+    def __init__(self):
+        self.buffer = bytearray()  # unescaped bytes of the current frame
+        self.insync = False  # True once a frame start (#) has been seen
+        self.pending = b''  # trailing escape char awaiting its partner
+        self.discarding = False  # skipping bytes up to the next frame start
+        self.bytes_consumed = 0
+        self.frames_emitted = 0
+        self.resyncs = 0
+
+    def reset(self):
+        """discard partial data, e.g. after flushing the serial port"""
+        if self.insync and len(self.buffer) > 0:
+            self.resyncs += 1
+        self.buffer = bytearray()
+        self.insync = False
+        self.discarding = False
+        self.pending = b''
+
+    def feed(self, data):
+        """Decode raw bytes *data*, return list of complete frames.\n
+        Frames are returned without the leading '#', i.e. in the form
+        expected by TPacket."""
+        frames = []
+        if not data:
+            return frames
+        self.bytes_consumed += len(data)
+        data = self.pending + bytes(data)
+        self.pending = b''
+        if data.endswith(b'@'):
+            # escape sequence split over two reads, resolve on next call
+            data, self.pending = data[:-1], b'@'
+        # a raw '#' always marks a frame start, escaped ones read '@e'
+        segments = data.split(b'#')
+        for i, segment in enumerate(segments):
+            if i > 0:
+                if self.insync and len(self.buffer) > 0:
+                    self.resyncs += 1  # frame interrupted by a new start
+                self.buffer = bytearray()
+                self.insync = True
+                self.discarding = False
+            elif not self.insync:
+                # omit incomplete sequence at start
+                if segment and not self.discarding:
+                    self.resyncs += 1
+                    self.discarding = True
+                continue
+            if not segment:
+                continue
+            self._unescape_into(segment)
+            frame = self._take_frame()
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    def _unescape_into(self, segment):
+        parts = segment.split(b'@')
+        buf = self.buffer
+        buf += parts[0]
+        for part in parts[1:]:
+            if not part:
+                continue
+            try:
+                buf.append(self.escapes[part[0]])
+                buf += memoryview(part)[1:]
+            except KeyError:
+                buf.append(0x40)  # unknown escape, keep as is
+                buf += part
+
+    def _take_frame(self):
+        buf = self.buffer
+        if len(buf) < 1:
+            return None
+        # 1st byte after # = size
+        blocklength = 7 + 2*2**(buf[0] >> 5)
+        if len(buf) < blocklength:
+            return None
+        if len(buf) > blocklength:
+            self.resyncs += 1  # trailing garbage up to the next '#'
+            self.discarding = True
+        frame = bytes(buf[:blocklength])
+        self.buffer = bytearray()
+        self.insync = False  # wait for the next frame start
+        self.frames_emitted += 1
+        return frame
+
+    def __repr__(self):
+        msg = "<PyTrios TDecoder: {0} bytes, {1} frames, {2} resyncs>"\
+            .format(self.bytes_consumed, self.frames_emitted, self.resyncs)
+        return msg
+
+
+class TListenStats(object):
+    """Listener statistics for a single serial port:\n
+    *wakeups* = number of times the listener found data waiting\n
+    *bytes_read* = raw bytes read from the port\n
+    *frames* = frames dispatched to handlePacket\n
+    *cputime* = CPU seconds spent by the listening thread\n
+    *latency_mean*, *latency_max* = seconds from the earliest time the
+    data of a frame can have arrived to its dispatch: the previous poll in
+    'poll' mode, the wakeup if the data woke a waiting listener, or the
+    previous read if the data was already waiting. An upper bound of the
+    delay since arrival, so in 'poll' mode it includes the poll interval.\n
+    *processing_mean*, *processing_max* = seconds from wakeup (data found
+    waiting) to dispatch\n"""
+    def __init__(self):
+        self.started = time.time()
+        self.wakeups = 0
+        self.bytes_read = 0
+        self.frames = 0
+        self.cputime = 0.0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.processing_sum = 0.0
+        self.processing_max = 0.0
+
+    def record(self, nbytes, latencies, processing=None):
+        """register one wakeup with *nbytes* read, per-frame latencies and
+        per-frame processing times (same as latencies if None)"""
+        if processing is None:
+            processing = latencies
+        self.wakeups += 1
+        self.bytes_read += nbytes
+        self.frames += len(latencies)
+        for lat, proc in zip(latencies, processing):
+            self.latency_sum += lat
+            self.processing_sum += proc
+            if lat > self.latency_max:
+                self.latency_max = lat
+            if proc > self.processing_max:
+                self.processing_max = proc
+
+    @property
+    def latency_mean(self):
+        if self.frames == 0:
+            return None
+        return self.latency_sum / self.frames
+
+    @property
+    def processing_mean(self):
+        if self.frames == 0:
+            return None
+        return self.processing_sum / self.frames
+
+    @property
+    def cpuload(self):
+        """fraction of wall clock time the listener used the CPU"""
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.cputime / elapsed
+
+    def __repr__(self):
+        msg = "<PyTrios TListenStats: {0} wakeups, {1} bytes, {2} frames, "\
+            .format(self.wakeups, self.bytes_read, self.frames)\
+            + "latency {0:.4f} s (max {1:.4f} s), ".format(
+                self.latency_mean or 0.0, self.latency_max)\
+            + "processing {0:.4f} s (max {1:.4f} s), cpu {2:.2%}>".format(
+                self.processing_mean or 0.0, self.processing_max,
+                self.cpuload)
+        return msg
+
+
 class TPacket(object):
     """TrioS sensor data package object"""
     def __init__(self, s2parse=None):
@@ -101,6 +285,8 @@ class TPacket(object):
         # 0 = no realtime clock
         self.time2 = Data[5]
         self.databytes = Data[6:6+self.id1_databytes]
+        # the same data bytes without copying, e.g. for np.frombuffer
+        self.databuffer = memoryview(s2parse)[6:6+self.id1_databytes]
         self.checkbyte = Data[-1]  # not used
         self.tid1 = hex(self.id1_id)[2:].zfill(2)
         self.tid2 = hex(self.id2)[2:].zfill(2)
@@ -206,18 +392,125 @@ class SAMSettings(object):
         pass
 
 
+class TRingBuffer(object):
+    """Fixed capacity history of measurements in contiguous numpy storage.\n
+    Written by a single producer (the listening thread), read without
+    locking. Readers detect and discard entries that were overwritten
+    while they were being copied.\n
+    *data* = (capacity x width) array of measurements\n
+    *times* = reception timestamps (POSIX seconds)\n
+    *inttimes* = integration times in ms (0 if not applicable)\n
+    *written* = total number of entries appended\n
+    *dropped* = entries overwritten before they were drained\n"""
+    def __init__(self, capacity, width=256, dtype=np.uint16):
+        self.capacity = int(capacity)
+        self.data = np.zeros((self.capacity, width), dtype=dtype)
+        self.times = np.zeros(self.capacity, dtype=np.float64)
+        self.inttimes = np.zeros(self.capacity, dtype=np.int32)
+        self.written = 0
+        self.claimed = 0  # entries written or being written
+        self.readpos = 0  # first entry not yet drained
+        self.dropped = 0
+
+    def append(self, values, timestamp, inttime=0):
+        """add a measurement, overwriting the oldest one when full"""
+        i = self.written % self.capacity
+        self.claimed = self.written + 1  # announce the slot is in use
+        self.data[i] = values
+        self.times[i] = timestamp
+        self.inttimes[i] = inttime
+        self.written += 1  # publish only after the slot is complete
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def _copy(self, start, end):
+        idx = np.arange(start, end) % self.capacity
+        times = self.times[idx]
+        data = self.data[idx]
+        inttimes = self.inttimes[idx]
+        # entries the producer has overwritten (or is writing) meanwhile
+        overrun = self.claimed - self.capacity - start
+        if overrun > 0:
+            times, data, inttimes = \
+                times[overrun:], data[overrun:], inttimes[overrun:]
+        return times, data, inttimes, max(overrun, 0)
+
+    def latest(self, n=None):
+        """copies of the last *n* entries (all held entries if None) as
+        (times, data, inttimes), oldest first"""
+        end = self.written
+        if n is None:
+            n = self.capacity
+        start = max(0, end - min(n, self.capacity))
+        return self._copy(start, end)[:3]
+
+    def drain(self):
+        """copies of all entries appended since the previous drain as
+        (times, data, inttimes), oldest first. Entries overwritten before
+        they could be drained are counted in *dropped*."""
+        end = self.written
+        start = max(self.readpos, end - self.capacity)
+        self.dropped += start - self.readpos
+        times, data, inttimes, overrun = self._copy(start, end)
+        self.dropped += overrun
+        self.readpos = end
+        return times, data, inttimes
+
+    def __repr__(self):
+        msg = "<PyTrios TRingBuffer: {0}/{1} entries, {2} undrained, "\
+            .format(len(self), self.capacity,
+                    min(self.written - self.readpos, self.capacity))\
+            + "{0} dropped>".format(self.dropped)
+        return msg
+
+
 class TSAM(object):
     """Represents a SAM instrument:\n
     *Settings* = Sensor specific settings\n
-    *lastRawSAM* = last uncalibrated spectrum from SAM unit\n
-    *lastRawSAMTime* = Reception timestamp of last spectrum\n"""
-    def __init__(self, Settings=SAMSettings, dataframes=[[None]]*8,
-                 lastRawSAM=None, lastRawSAMTime=None, lastIntTime=None):
+    *lastRawSAMArray* = last uncalibrated spectrum (numpy uint16 array)\n
+    *lastRawSAM* = same spectrum as list of int (backward compatibility)\n
+    *lastRawSAMTime* = Reception timestamp of last spectrum\n
+    *framebuffer* = incoming spectrum frames (8 x 32 pixels)\n
+    *history* = optional TRingBuffer of past spectra (see enable_history)\n"""
+    def __init__(self, Settings=SAMSettings, lastRawSAM=None,
+                 lastRawSAMTime=None, lastIntTime=None):
         self.Settings = Settings()
-        self.dataframes = dataframes
+        self.framebuffer = np.zeros((8, 32), dtype=np.uint16)
+        self.framemask = 0  # bit n set once frame n has been received
         self.lastRawSAMTime = lastRawSAMTime
         self.lastRawSAM = lastRawSAM
         self.lastIntTime = lastIntTime
+        self.history = None
+
+    def enable_history(self, capacity):
+        """keep the last *capacity* spectra, timestamps and integration
+        times in a TRingBuffer (self.history)"""
+        self.history = TRingBuffer(capacity, width=256, dtype=np.uint16)
+        return self.history
+
+    @property
+    def lastRawSAMArray(self):
+        return self._lastRawSAMArray
+
+    @lastRawSAMArray.setter
+    def lastRawSAMArray(self, spectrum):
+        self._lastRawSAMArray = spectrum
+        self._lastRawSAMList = None
+
+    @property
+    def lastRawSAM(self):
+        """last spectrum as list of int, converted on first access"""
+        if self._lastRawSAMList is None and\
+                self._lastRawSAMArray is not None:
+            self._lastRawSAMList = self._lastRawSAMArray.tolist()
+        return self._lastRawSAMList
+
+    @lastRawSAM.setter
+    def lastRawSAM(self, spectrum):
+        if spectrum is not None:
+            spectrum = np.asarray(spectrum, dtype=np.uint16)
+        self.lastRawSAMArray = spectrum
 
     def __repr__(self):
         ltime = self.lastRawSAMTime
@@ -274,7 +567,8 @@ class TMicroFlu(object):
     *ROMConfig* = Sensor startup configuration\n
     *lastFluRaw* = last raw measurement (amplification, value)\n
     *lastFluCal* = last calibrated measurement\n
-    *lastFluTime* = local timestamp of last measurement\n"""
+    *lastFluTime* = local timestamp of last measurement\n
+    *history* = optional TRingBuffer of past measurements\n"""
     def __init__(self, Settings=MFSettings, ROMConfig=MFROMConfig,
                  lastFluRaw=None, lastFluCal=None, lastFluTime=None):
         self.Settings = Settings()
@@ -282,6 +576,13 @@ class TMicroFlu(object):
         self.lastfluRaw = lastFluRaw
         self.lastFluCal = lastFluCal
         self.lastFluTime = lastFluTime
+        self.history = None
+
+    def enable_history(self, capacity):
+        """keep the last *capacity* measurements as (gain, raw, calibrated)
+        rows with timestamps in a TRingBuffer (self.history)"""
+        self.history = TRingBuffer(capacity, width=3, dtype=np.float64)
+        return self.history
 
     def __repr__(self):
         ftypes = ['', 'Chl', 'Blue', 'CDOM']
@@ -310,6 +611,155 @@ class TChannel(object):
         self.serial = None  # recursively link ser object when query received
         self.lasttrigger = None
         self.lastcommand = 'query'
+        self._condition = threading.Condition()
+        self._measurements = 0  # measurements completed
+        self._triggered = 0  # measurements completed at last trigger
+        self._futures = []  # (loop, future, trigger) awaiting a measurement
+        self._callbacks = []
+        self.continuous = None  # queue of (time, data, inttime)
+        self.cont_active = False  # measurements go into the queue
+        self.cont_received = 0  # measurements received in continuous mode
+        self.cont_dropped = 0  # oldest measurements dropped on a full queue
+
+    def _set_trigger(self, command, trigger):
+        with self._condition:
+            self.lastcommand = command
+            self.lasttrigger = trigger
+            self._triggered = self._measurements
+
+    def _measurement_done(self, data, timestamp=None, inttime=None):
+        '''called by the packet interpreters once a measurement is complete'''
+        if self.cont_active:
+            self._enqueue((timestamp, data, inttime))
+        with self._condition:
+            self._measurements += 1
+            # a late measurement of an earlier (timed out) trigger must not
+            # resolve a measure() call triggered since
+            futures = [f for f in self._futures
+                       if timestamp is not None and timestamp > f[2]]
+            self._futures = [f for f in self._futures if f not in futures]
+            callbacks = self._callbacks[:]
+            self._condition.notify_all()
+        for loop, future, trigger in futures:
+            try:
+                loop.call_soon_threadsafe(_resolve_future, future, data)
+            except RuntimeError:
+                pass  # event loop closed in the meantime
+        for callback in callbacks:
+            try:
+                callback(self, data)
+            except Exception as e:
+                if self.verbosity >= 1:
+                    print("tchannel: callback {0} failed: {1}"
+                          .format(callback, e), file=sys.stderr)
+
+    def _enqueue(self, record):
+        self.cont_received += 1
+        self.cont_dropped += put_drop_oldest(self.continuous, record)
+
+    def start_continuous(self, ser=None, inttime=0, maxqueue=100):
+        '''put a SAM sensor in free-running mode (no trigger per sample).\n
+        *inttime* = integration time in ms (0 = autorange)\n
+        *maxqueue* = measurements held for the consumer. When the queue is
+        full the oldest measurement is dropped and counted in cont_dropped.
+        \nRetrieve measurements with get_continuous().'''
+        if self.TInfo.ModuleType not in ['SAM', 'SAMIP']:
+            if self.verbosity >= 1:
+                print("tchannel: start_continuous not implemented for {0}"
+                      .format(self.TInfo.ModuleType), file=sys.stderr)
+            return
+        if ser is None:
+            ser = self.serial
+        par = INTTIMES[inttime]
+        self.continuous = queue.Queue(maxsize=maxqueue)
+        self.cont_received = 0
+        self.cont_dropped = 0
+        self.cont_active = True
+        self._set_trigger('continuous', datetime.datetime.now())
+        self._send_command(ser, command='cont_mode_on')
+        self._send_command(ser, command='startIntSet', par=par)
+
+    def stop_continuous(self, ser=None):
+        '''end free-running mode, measurements still queued are kept
+        available through get_continuous()'''
+        if self.TInfo.ModuleType not in ['SAM', 'SAMIP']:
+            return
+        if ser is None:
+            ser = self.serial
+        self.cont_active = False
+        self._send_command(ser, command='cont_mode_off')
+        self.lastcommand = 'cont_mode_off'
+
+    def get_continuous(self, timeout=None):
+        '''next (time, spectrum, inttime) from continuous mode, blocks up
+        to *timeout* s. Returns None if nothing arrived in time.'''
+        if self.continuous is None:
+            return None
+        try:
+            return self.continuous.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def on_spectrum(self, callback):
+        '''register *callback(channel, data)*, called on the listening
+        thread whenever a measurement completes. *data* is the raw spectrum
+        (SAM, numpy array) or calibrated value (MicroFlu). Returns
+        *callback*.'''
+        with self._condition:
+            if callback not in self._callbacks:
+                self._callbacks.append(callback)
+        return callback
+
+    def remove_callback(self, callback):
+        '''unregister a callback added with on_spectrum'''
+        with self._condition:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait_for_measurement(self, timeout=None):
+        '''block until a measurement arrives that was triggered by the last
+        command, or until *timeout* seconds have passed.\n
+        Returns True if the measurement arrived, False on timeout.'''
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._measurements > self._triggered, timeout)
+
+    async def measure(self, ser=None, inttime=0, timeout=None):
+        '''trigger a measurement and await its result (asyncio).\n
+        *ser* = serial port, defaults to the port the channel was found on\n
+        *inttime* = integration time in ms (SAM only, 0 = auto)\n
+        *timeout* = seconds, defaults to TIMEOUT_SAM / TIMEOUT_MF\n
+        Returns the raw spectrum (SAM, numpy array) or calibrated value
+        (MicroFlu).
+        MicroFlu sensors are not triggered, the next reading is awaited.
+        Measurements time-stamped at or before the trigger (late replies to
+        an earlier trigger) are not returned.
+        Raises asyncio.TimeoutError if no measurement arrives in time.'''
+        if ser is None:
+            ser = self.serial
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        trigger = datetime.datetime.now()
+        pending = (loop, future, trigger)
+        with self._condition:
+            self._futures.append(pending)
+        if self.TInfo.ModuleType in ['SAM', 'SAMIP']:
+            if timeout is None:
+                timeout = TIMEOUT_SAM
+            if inttime > 0:
+                self.startIntSet(ser, inttime, trigger=trigger)
+            else:
+                self.startIntAuto(ser, trigger=trigger)
+        else:
+            if timeout is None:
+                timeout = TIMEOUT_MF
+            self._set_trigger('measurement', trigger)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            with self._condition:
+                if pending in self._futures:
+                    self._futures.remove(pending)
 
     def is_pending(self):
         '''check whether new measurement is pending (False if timed out)'''
@@ -348,9 +798,16 @@ class TChannel(object):
         ipschan = self.TInfo.TID[0:2]
         TCommandSend(ser, commandset, command, ipschan, par1=par)
 
+    def _measure_command(self, inttime=0):
+        '''(commandset, command, ipschan, par1) starting a SAM measurement,
+        e.g. for TCommandSendBatch'''
+        ipschan = self.TInfo.TID[0:2]
+        if inttime > 0:
+            return ('SAM', 'startIntSet', ipschan, INTTIMES[inttime])
+        return ('SAM', 'startIntAuto', ipschan, '00')
+
     def query(self, ser, trigger=datetime.datetime.now()):
-        self.lastcommand = 'query'
-        self.lasttrigger = trigger
+        self._set_trigger('query', trigger)
         self._send_command(ser, command='query')
 
     def startIntAuto(self, ser, trigger=datetime.datetime.now()):
@@ -359,8 +816,7 @@ class TChannel(object):
                 print("tchannel: startIntAuto not implemented for {0}"
                       .format(self.TInfo.ModuleType), file=sys.stderr)
             return
-        self.lastcommand = 'measurement'
-        self.lasttrigger = trigger
+        self._set_trigger('measurement', trigger)
         self._send_command(ser, command='startIntAuto', par='00')
 
     def startIntSet(self, ser, inttime, trigger=datetime.datetime.now()):
@@ -372,12 +828,8 @@ class TChannel(object):
                 print("tchannel: startIntSet not implemented for {0}"
                       .format(self.TInfo.ModuleType), file=sys.stderr)
             return
-        inttimes = {0: '00', 8: '02', 16: '03', 32: '04', 64: '05',
-                    128: '06', 256: '07', 512: '08', 1024: '09',
-                    2048: '0A', 4096: '0B', 8192: '0C'}
-        par = inttimes[inttime]
-        self.lastcommand = 'measurement'
-        self.lasttrigger = trigger
+        par = INTTIMES[inttime]
+        self._set_trigger('measurement', trigger)
         self._send_command(ser, command='startIntSet', par=par)
 
     def __repr__(self):
@@ -393,6 +845,93 @@ class TChannel(object):
             return "<PyTrios channel (no info)>"
 
 
+def _resolve_future(future, data):
+    if not future.done():
+        future.set_result(data)
+
+
+# Command templates per command set, {0} = ipschan, {1} = par1
+COMMANDS = {
+    None: {'query': "23 {0} 00 80 B0 00 00 01"},
+    'MicroFlu': {
+        'ReadCfg': "23 {0} 00 00 c0 00 00 01 23 {0} 00 00 08 00 03 01 "
+                   "23 {0} 00 00 08 00 04 01 23 {0} 00 00 a0 a4 10 01",
+        'cont_on': "23 {0} 00 00 78 0f 01 01",
+        'cont_off': "23 {0} 00 00 78 0f 00 01",
+        'query': "23 {0} 00 00 B0 00 00 01",
+        'start': "23 {0} 00 00 A8 00 81 01",
+        'stop': "23 {0} 00 00 A8 00 82 01",
+        'autoamp_on': "23 {0} 00 00 78 06 01 01",
+        'autoamp_off': "23 {0} 00 00 78 06 00 01",
+        'lowamp_on': "23 {0} 00 00 78 05 01 01",
+        'lowamp_off': "23 {0} 00 00 78 05 00 01",
+        'int_avg': "23 {0} 00 00 78 04 {1} 01"},
+    # SAM address = 80
+    # SAMIP address = 80 but 20 for IP and 30 for SAM commands
+    'SAM': {
+        'startIntAuto': "23 {0} 00 30 78 05 00 01 23 {0} 00 80 A8 00 81 01",
+        # valid par1 values for startIntset: see INTTIMES
+        'startIntSet': "23 {0} 00 30 78 05 {1} 01 23 {0} 00 80 A8 00 81 01",
+        'cont_mode_off': "23 {0} 00 30 78 F0 02 01",
+        'cont_mode_on': "23 {0} 00 30 78 F0 03 01",
+        'setIntTime': "23 {0} 00 30 78 05 {1} 01",
+        'sleep': "23 {0} 00 80 A0 00 00 01",
+        'setbaud': "23 {0} 00 30 50 01 {1} 01",
+        'fastauto': "23 {0} 00 30 50 01 0C 01 23 {0} 00 30 78 F0 03 01",
+        'query_sam': "23 {0} 00 30 B0 00 00 01"}}
+"""
+Note baudrate changes did not function with an IPS box. Test further.
+valid (hex) par1 values for setbaud:
+2 400 baud: par = CF
+4 800 baud: par = 67
+9 600 baud: par = 33
+19 200 baud: par = 19
+38 400 baud: par = 0C
+(57 600 baud: par = 08, only at 8MHz)
+
+valid (hex) pars for inttime:
+00: autorange
+02 8ms, 03 16ms, 04 32ms, 05 64ms, 06 128ms, 07 256ms
+08 512ms, 09 1024ms, 0A 2048ms, 0B 4096ms, 0C 8192ms
+"""
+
+_commandcache = {}  # (commandset, command, ipschan, par1): bytes
+
+
+def TCommandBytes(commandset, command='query', ipschan='00', par1='00'):
+    """Command bytes for a TriOS device, compiled once and cached.\n
+    Arguments as for TCommandSend. Raises KeyError for unknown commands."""
+    template = COMMANDS[commandset][command]
+    if '{1}' not in template:
+        par1 = None  # one cache entry regardless of unused parameter
+    key = (commandset, command, str(ipschan), par1 and str(par1))
+    try:
+        return _commandcache[key]
+    except KeyError:
+        commandhex = bytes(bytearray.fromhex(template.format(key[2],
+                                                             key[3])))
+        _commandcache[key] = commandhex
+        return commandhex
+
+
+def _write_command(ser, commandhex, description):
+    try:
+        if ser.out_waiting > 0:
+            ser.flush()
+        ser.write(commandhex)
+        if ser.verbosity >= 3:
+            print("{0} written to {1}".format(description, ser.port),
+                  file=sys.stdout)
+    except serial.SerialException as e:
+        print(e, file=sys.stderr)
+        pass
+    except Exception:
+        if ser.verbosity >= 1:
+            emsg = "TCommandSend: Unidentified error, please check format"
+            print(emsg, file=sys.stderr)
+        pass
+
+
 def TCommandSend(ser, commandset, command='query', ipschan='00', par1='00'):
     """Send command to a TriOS device.\n
     Device configuration commands are not supported.\n
@@ -414,100 +953,14 @@ def TCommandSend(ser, commandset, command='query', ipschan='00', par1='00'):
     the documentation, even when listed as parameter2 in the docs.
     Most commands require at most one argument.\n\n
     """
-    commandsetdict = {None: 0, 'MicroFlu': 1, 'SAM': 2}
-    commanddict = ['']*len(commandsetdict)
-    commanddict[0] = {'query': bytearray.fromhex("23 "
-                      + str(ipschan) + " 00 80 B0 00 00 01")}
-    commanddict[1] = {
-        'ReadCfg': bytearray.fromhex("23 " + str(ipschan)
-                                     + " 00 00 c0 00 00 01 23 " + ipschan
-                                     + " 00 00 08 00 03 01 23 " + ipschan
-                                     + " 00 00 08 00 04 01 23 " + ipschan
-                                     + " 00 00 a0 a4 10 01"),
-        'cont_on': bytearray.fromhex("23 " + str(ipschan)
-                                     + " 00 00 78 0f 01 01"),
-        'cont_off': bytearray.fromhex("23 " + str(ipschan)
-                                      + " 00 00 78 0f 00 01"),
-        'query': bytearray.fromhex("23 " + str(ipschan)
-                                   + " 00 00 B0 00 00 01"),
-        'start': bytearray.fromhex("23 " + str(ipschan)
-                                   + " 00 00 A8 00 81 01"),
-        'stop': bytearray.fromhex("23 " + str(ipschan)
-                                  + " 00 00 A8 00 82 01"),
-        'autoamp_on': bytearray.fromhex("23 " + str(ipschan)
-                                        + " 00 00 78 06 01 01"),
-        'autoamp_off': bytearray.fromhex("23 " + str(ipschan)
-                                         + " 00 00 78 06 00 01"),
-        'lowamp_on': bytearray.fromhex("23 " + str(ipschan)
-                                       + " 00 00 78 05 01 01"),
-        'lowamp_off': bytearray.fromhex("23 " + str(ipschan)
-                                        + " 00 00 78 05 00 01"),
-        'int_avg': bytearray.fromhex("23 " + str(ipschan)
-                                     + " 00 00 78 04 " + str(par1) + " 01")}
+    commandhex = TCommandBytes(commandset, command, ipschan, par1)
+    _write_command(ser, commandhex, "{0} ({1})".format(command, ipschan))
 
-    # SAM address = 80
-    # SAMIP address = 80 but 20 for IP and 30 for SAM commands
-    commanddict[2] = {
-        'startIntAuto': bytearray.fromhex("23 " + str(ipschan)
-                                          + " 00 30 78 05 00 01 23 "
-                                          + str(ipschan)
-                                          + " 00 80 A8 00 81 01"),
-        # valid par1 values for startIntset:
-        'startIntSet': bytearray.fromhex("23 " + str(ipschan)
-                                         + " 00 30 78 05 " + str(par1)
-                                         + " 01 23 " + str(ipschan)
-                                         + " 00 80 A8 00 81 01"),
-        'cont_mode_off': bytearray.fromhex("23 " + str(ipschan)
-                                           + " 00 30 78 F0 02 01"),
-        'cont_mode_on': bytearray.fromhex("23 " + str(ipschan)
-                                          + " 00 30 78 F0 03 01"),
-        'setIntTime': bytearray.fromhex("23 " + str(ipschan)
-                                        + " 00 30 78 05 "+str(par1)+" 01"),
-        'sleep': bytearray.fromhex("23 " + str(ipschan)
-                                   + " 00 80 A0 00 00 01"),
-        'setbaud': bytearray.fromhex("23 " + str(ipschan)
-                                     + " 00 30 50 01 "+str(par1)+" 01"),
-        'fastauto': bytearray.fromhex("23 " + str(ipschan)
-                                      + " 00 30 50 01 0C 01 23 " + str(ipschan)
-                                      + " 00 30 78 F0 03 01"),
-        'query_sam': bytearray.fromhex("23 " + str(ipschan)
-                                       + " 00 30 B0 00 00 01")}
-
-    """
-    Note baudrate changes did not function with an IPS box. Test further.
-    valid (hex) par1 values for setbaud:
-    2 400 baud: par = CF
-    4 800 baud: par = 67
-    9 600 baud: par = 33
-    19 200 baud: par = 19
-    38 400 baud: par = 0C
-    (57 600 baud: par = 08, only at 8MHz)
-
-    valid (hex) pars for inttime:
-    00: autorange
-    02 8ms, 03 16ms, 04 32ms, 05 64ms, 06 128ms, 07 256ms
-    08 512ms, 09 1024ms, 0A 2048ms, 0B 4096ms, 0C 8192ms
-    """
 
-    commandhex = commanddict[commandsetdict[commandset]][command]
-    try:
-        if ser.out_waiting > 0:
-            ser.flush()
-        ser.write(commandhex)
-        if ser.verbosity >= 3:
-            print("{0} written to {1} ({2})".format(command,
-                                                    ser.port,
-                                                    ipschan), file=sys.stdout)
-    except serial.SerialException as e:
-        print(e.message, file=sys.stderr)
-        pass
-    except KeyError:
-        if ser.verbosity >= 1:
-            emsg = "TCommandSend: Command or command set not recognized"
-            print(emsg, file=sys.stderr)
-        pass
-    except Exception:
-        if ser.verbosity >= 1:
-            emsg = "TCommandSend: Unidentified error, please check format"
-            print(emsg, file=sys.stderr)
-        pass
+def TCommandSendBatch(ser, commands):
+    """Send several commands to TriOS devices on *ser* in a single write.\n
+    *commands* = list of (commandset, command, ipschan, par1) tuples, par1
+    may be omitted. See TCommandSend for the available commands."""
+    commandhex = b''.join(TCommandBytes(*c) for c in commands)
+    description = ", ".join("{0} ({1})".format(c[1], c[2]) for c in commands)
+    _write_command(ser, commandhex, description)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Small helpers shared by the PyTrios modules
+"""
+import itertools
+import collections
+import queue
+
+
+def read_chunks(f, chunksize):
+    """lists of up to *chunksize* lines from an open file"""
+    while True:
+        lines = list(itertools.islice(f, chunksize))
+        if not lines:
+            return
+        yield lines
+
+
+def ordered_map(pool, function, iterable, depth):
+    """function(item) for every item on executor *pool*, yielded in input
+    order. At most *depth* items are submitted ahead of the results
+    consumed, so large inputs are never read into memory at once."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.submit(function, item))
+        while len(pending) >= depth or (pending and pending[0].done()):
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def put_drop_oldest(q, item):
+    """put *item* on bounded queue *q* without blocking, dropping the
+    oldest entries to make room. Returns the number of entries dropped."""
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
@@ -3,10 +3,16 @@ Multithreaded GPS library
 Terry C provided this
 """
 import datetime
+import functools
 import logging
-import re
+import operator
+import os
 import threading
 import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .TClasses import TRingBuffer
+from ._utils import read_chunks, ordered_map
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
 logger = logging.getLogger(__name__)
@@ -15,7 +21,9 @@ logger = logging.getLogger(__name__)
 class GPSParser(object):
     """
     Class which contains a parse and checksum method.
-    Will parse GPGGA, GPRMC, GPVTG, and HCHDG NMEA sentences
+    Will parse GGA, RMC, VTG, GSA and HDG NMEA sentences from any talker
+    (e.g. GPGGA, GNGGA, HCHDG), see SENTENCE_PARSERS.
+    Sentences may be str or bytes (as returned by serial.readline()).
     """
     @staticmethod
     def checksum(sentence):
@@ -23,21 +31,33 @@ class GPSParser(object):
         Check and validate GPS NMEA sentence
 
         :param sentence: NMEA sentence
-        :type sentence: str
+        :type sentence: bytes or str
 
         :return: True if checksum is valid, False otherwise
         :rtype: bool
         """
-        sentence = sentence.strip()
-        match = re.search(r'^\$(.*\*.*)$', sentence)
-        if match:
-            sentence = match.group(1)
-            nmeadata, cksum = re.split(r'\*', sentence)
-            calc_cksum = 0
-            for char in nmeadata:
-                calc_cksum ^= ord(char)
-            return '0x'+cksum.lower() == hex(calc_cksum)
-        return False
+        sentence = _as_bytes(sentence).strip()
+        star = sentence.rfind(b'*')
+        if not sentence.startswith(b'$') or star < 0:
+            return False
+        try:
+            cksum = int(sentence[star+1:], 16)
+        except ValueError:
+            return False
+        return functools.reduce(operator.xor, sentence[1:star], 0) == cksum
+
+    @staticmethod
+    def checksum_many(sentences):
+        """
+        Validate the checksums of many NMEA sentences at once
+
+        :param sentences: NMEA sentences
+        :type sentences: sequence of bytes or str
+
+        :return: True for every sentence with a valid checksum
+        :rtype: numpy.ndarray of bool
+        """
+        return _checksums(sentences)[1]
 
     @staticmethod
     def parse(gps_string):
@@ -45,26 +65,51 @@ class GPSParser(object):
         Parse a GPS NMEA sentence, Returns NMEA dictionary or None
 
         :param gps_string: NMEA sentence.
-        :type gps_string: str
+        :type gps_string: bytes or str
 
         :return: Function output or None
         """
         if GPSParser.checksum(gps_string):
-            try:
-                if gps_string.startswith('$GPGSA'):
-                    return GPSParser.parse_gpgsa(gps_string)
-                if gps_string.startswith('$GPGGA'):
-                    return GPSParser.parse_gpgga(gps_string)
-                elif gps_string.startswith('$GPRMC'):
-                    return GPSParser.parse_gprmc(gps_string)
-                elif gps_string.startswith('$GPVTG'):
-                    return GPSParser.parse_gpvtg(gps_string)
-                elif gps_string.startswith('$HCHDG'):
-                    return GPSParser.parse_hchdg(gps_string)
-            except ValueError:
-                pass
+            return GPSParser._dispatch(gps_string)
         return None
 
+    @staticmethod
+    def parse_many(gps_strings):
+        """
+        Parse many NMEA sentences, e.g. the lines of a log file.
+        Checksums are validated in one vectorized pass.
+
+        :param gps_strings: NMEA sentences
+        :type gps_strings: sequence of bytes or str
+
+        :return: NMEA dictionaries of the sentences that could be parsed
+        :rtype: list
+        """
+        valid = GPSParser.checksum_many(gps_strings)
+        results = []
+        for gps_string, ok in zip(gps_strings, valid):
+            if ok:
+                result = GPSParser._dispatch(gps_string)
+                if result is not None:
+                    results.append(result)
+        return results
+
+    @staticmethod
+    def _dispatch(gps_string):
+        """parse a sentence with a valid checksum, None if unsupported"""
+        if isinstance(gps_string, bytes):
+            try:
+                gps_string = gps_string.decode('ascii')
+            except UnicodeDecodeError:
+                return None
+        parser = SENTENCE_PARSERS.get(gps_string.lstrip()[3:6])
+        if parser is None:
+            return None
+        try:
+            return parser(gps_string)
+        except (ValueError, IndexError):
+            return None
+
     @staticmethod
     def parse_gpgsa(gpgsa_string):
         """
@@ -227,10 +272,74 @@ class GPSParser(object):
         return result
 
 
+# parsers by sentence id (the talker id, e.g. GP, GN or HC, is ignored)
+SENTENCE_PARSERS = {
+    'GSA': GPSParser.parse_gpgsa,
+    'GGA': GPSParser.parse_gpgga,
+    'RMC': GPSParser.parse_gprmc,
+    'VTG': GPSParser.parse_gpvtg,
+    'HDG': GPSParser.parse_hchdg,
+}
+
+
+def _as_bytes(sentence):
+    if isinstance(sentence, str):
+        return sentence.encode('latin-1', 'replace')
+    return bytes(sentence)
+
+
+# value of each byte as a hexadecimal digit, -1 if it is not one
+_HEXDIGITS = np.full(256, -1, dtype=np.int64)
+_HEXDIGITS[np.frombuffer(b'0123456789ABCDEFabcdef', dtype=np.uint8)] = \
+    list(range(16)) + list(range(10, 16))
+
+
+def _checksums(sentences):
+    """(stripped sentences as bytes, valid checksum mask, position of the
+    '*' of each sentence), see GPSParser.checksum_many"""
+    sentences = [s.strip() if isinstance(s, bytes) else _as_bytes(s).strip()
+                 for s in sentences]
+    lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+    stars = np.array([s.rfind(b'*') for s in sentences], dtype=np.int64)
+    if not sentences:
+        return sentences, np.zeros(0, dtype=bool), stars
+    starts = np.cumsum(lengths) - lengths
+    # padded, so the two bytes after a '*' can always be indexed
+    data = np.frombuffer(b''.join(sentences) + b'\0\0\0', dtype=np.uint8)
+    # the usual two hex digit checksum is decoded from the joined bytes,
+    # other lengths one by one
+    two = (stars > 0) & (lengths - stars == 3)
+    high = _HEXDIGITS[data[starts + stars + 1]]
+    low = _HEXDIGITS[data[starts + stars + 2]]
+    given = np.where(two & (high >= 0) & (low >= 0), high*16 + low, -1)
+    for i in np.flatnonzero((stars > 0) & ~two).tolist():
+        try:
+            given[i] = int(sentences[i][stars[i]+1:], 16)
+        except ValueError:
+            pass
+    ok = (given >= 0) & (lengths > 0) & (data[starts] == ord('$'))
+    # xor of a sentence body from the running xor of all sentences
+    running = np.bitwise_xor.accumulate(data)
+    first, last = starts[ok], starts[ok] + stars[ok] - 1
+    valid = np.zeros(len(sentences), dtype=bool)
+    valid[ok] = (running[last] ^ running[first]) == given[ok]
+    return sentences, valid, stars
+
+
 class GPSSerialReader(threading.Thread):
     """
     Thread to read from a serial port
+
+    Blocks until a sentence arrives, then parses every complete sentence
+    waiting on the port before blocking again, so high rate (5-20 Hz)
+    receivers do not fall behind.
+
+    Statistics: sentences, parse_failures (bad checksum or malformed
+    supported sentence), sentence_rate, failure_rate, backlog (bytes
+    waiting after the last wakeup) and max_backlog.
     """
+    max_line = 4096  # longest partial sentence kept, bytes
+
     def __init__(self, serial_port, parent):
         threading.Thread.__init__(self)
         self.serial_port = serial_port
@@ -239,6 +348,12 @@ class GPSSerialReader(threading.Thread):
         self.observers = []
 
         self.current_gps_dict = None
+        self.started = time.time()
+        self.wakeups = 0
+        self.sentences = 0
+        self.parse_failures = 0
+        self.backlog = 0
+        self.max_backlog = 0
         logger.info("Starting GPS reader thread")
 
     def run(self):
@@ -248,15 +363,76 @@ class GPSSerialReader(threading.Thread):
         This will run and read from a GPS string and when it is valid
         and decoded it'll be passed via the observer design pattern.
         """
+        partial = b''
         while not self.parent.stop_gps:
-            gps_string = self.serial_port.readline()
-
-            logger.info("NMEA: {0}".format(gps_string.strip()))
-
-            self.current_gps_dict = GPSParser.parse(gps_string)
-            self.notify_observers()
+            try:
+                data = self.serial_port.readline()  # wait for a sentence
+                if not data:
+                    continue  # port timeout
+                waiting = self.serial_port.in_waiting
+                if waiting:
+                    data += self.serial_port.read(waiting)
+                self.backlog = self.serial_port.in_waiting
+            except (OSError, ValueError, TypeError) as e:
+                logger.error("GPS port {0} closed: {1}"
+                             .format(self.serial_port, e))
+                break
+            self.wakeups += 1
+            if self.backlog > self.max_backlog:
+                self.max_backlog = self.backlog
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            if len(partial) > self.max_line:
+                partial = b''  # no line end in sight, not NMEA
+            for gps_string in lines:
+                self._handle(gps_string)
+
+    def _handle(self, gps_string):
+        gps_string = gps_string.strip()
+        if not gps_string:
+            return
+        logger.info("NMEA: %s", gps_string)
+        self.sentences += 1
+        if not GPSParser.checksum(gps_string):
+            self.parse_failures += 1
+            return
+        self.current_gps_dict = GPSParser._dispatch(gps_string)
+        if self.current_gps_dict is None and \
+                gps_string[3:6].decode('ascii', 'replace') in \
+                SENTENCE_PARSERS:
+            self.parse_failures += 1
+        self.notify_observers()
+
+    @property
+    def sentence_rate(self):
+        """sentences per second since the thread was created"""
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.sentences / elapsed
+
+    @property
+    def failure_rate(self):
+        """fraction of sentences that failed to parse"""
+        if self.sentences == 0:
+            return 0.0
+        return self.parse_failures / float(self.sentences)
+
+    def stats(self):
+        """
+        Reader statistics
 
-            time.sleep(0.08)  # Sleep for a millisecond to spare CPU
+        :return: port, sentences, sentence_rate, parse_failures,
+            failure_rate, backlog and max_backlog
+        :rtype: dict
+        """
+        return {'port': getattr(self.serial_port, 'port', None),
+                'sentences': self.sentences,
+                'sentence_rate': self.sentence_rate,
+                'parse_failures': self.parse_failures,
+                'failure_rate': self.failure_rate,
+                'backlog': self.backlog,
+                'max_backlog': self.max_backlog}
 
     def register_observer(self, observer):
         """
@@ -315,8 +491,19 @@ class WatchdogTimer(object):
 class GPSManager(object):
     """
     Main GPS class which oversees the management and reading of GPS ports.
+
+    Positions are kept in a bounded history (PC receive time, lat, lon,
+    speed, heading) to georeference measurements, see
+    interpolate_position.
+
+    :param history: number of positions kept (0 = no history)
+    :type history: int
     """
-    def __init__(self):
+    def __init__(self, history=36000):
+        self.history = None
+        if history:
+            # columns: lat, lon, speed, heading
+            self.history = TRingBuffer(history, width=4, dtype=np.float64)
         self.serial_ports = []
         self.stop_gps = False
 
@@ -414,6 +601,8 @@ class GPSManager(object):
         """
         Stop watchdog timer.
         """
+        if self.watchdog is None:
+            return
         self.watchdog.stop()
         self.watchdog = None
         logger.debug("Stopped watchdog timer")
@@ -470,9 +659,44 @@ class GPSManager(object):
                 # Use track made good? for heading if no proper compass
                 if not self.proper_compass:
                     self.heading = gps_dict['heading']
+            if self.history is not None and \
+                    gps_dict['type'] in ('gpgga', 'gprmc'):
+                self.history.append([self.lat, self.lon,
+                                     _or_nan(self.speed),
+                                     _or_nan(self.heading)], time.time())
             self.notify_observers()
         self.gps_lock.release()
 
+    def interpolate_position(self, times, maxgap=None):
+        """
+        Position at arbitrary (PC clock) times, e.g. the timeStampPC of
+        spectra, interpolated between the fixes in the history.
+
+        :param times: datetime(s) or POSIX seconds
+        :param maxgap: maximum seconds between the fixes interpolated
+            (None = no limit)
+
+        :return: dict of arrays lat, lon, speed, heading (NaN outside the
+            history or across gaps)
+        :rtype: dict
+        """
+        if self.history is None:
+            raise ValueError("GPSManager keeps no position history")
+        t, track, _ = self.history.latest()
+        return interpolate_track(t, track[:, 0], track[:, 1], times,
+                                 speed=track[:, 2], heading=track[:, 3],
+                                 maxgap=maxgap)
+
+    def reader_stats(self):
+        """
+        Statistics of the serial reading threads, see
+        GPSSerialReader.stats
+
+        :return: one dict per serial port
+        :rtype: list
+        """
+        return [thread.stats() for thread in self.threads]
+
     def register_observer(self, gps_object):
         """
         Add object to the observing list
@@ -518,3 +742,304 @@ class GPSManager(object):
         :type wdg_callback: function
         """
         self.watchdog_callbacks.remove(wdg_callback)
+
+
+# columns of read_nmea_log, one row per sentence before merging
+_LOG_COLUMNS = ['lat', 'lon', 'speed', 'course', 'compass', 'fix', 'mode']
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def _log_floats(fields, required=False):
+    """NMEA fields as floats, NaN if empty. Returns (values, malformed),
+    empty fields count as malformed if *required*"""
+    text = np.array(fields, dtype=bytes)
+    empty = text == b''
+    bad = empty if required else np.zeros(len(fields), dtype=bool)
+    text[empty] = b'nan'
+    try:
+        return text.astype(np.float64), bad
+    except ValueError:
+        values = np.full(len(fields), np.nan)
+        for j, field in enumerate(fields):
+            try:
+                values[j] = float(field) if field else np.nan
+            except ValueError:
+                bad[j] = True
+        return values, bad
+
+
+def _log_tod(hhmmss):
+    """hhmmss.ss to seconds of the day"""
+    return np.floor(hhmmss/10000)*3600 + np.floor(hhmmss/100) % 100*60 +\
+        hhmmss % 100
+
+
+def _log_latlon(fields, hemispheres):
+    """(d)ddmm.mm fields and their N/S or E/W fields to signed degrees"""
+    value, bad = _log_floats(fields)
+    deg = np.floor(value/100)
+    value = deg + (value - deg*100)/60.0
+    hemispheres = np.array(hemispheres, dtype=bytes)
+    negative = (hemispheres == b'S') | (hemispheres == b'W')
+    return np.where(negative, -value, value), bad
+
+
+def _log_date(fields):
+    """ddmmyy fields to days since 1970-01-01"""
+    value, bad = _log_floats(fields, required=True)
+    value = np.where(np.isfinite(value), value, 0).astype(np.int64)
+    dd, mm, yy = value // 10000, value // 100 % 100, value % 100
+    month = ((yy + 30)*12 + mm - 1).astype('datetime64[M]')
+    first = month.astype('datetime64[D]')
+    length = ((month + 1).astype('datetime64[D]') - first).astype(np.int64)
+    bad = bad | (mm < 1) | (mm > 12) | (dd < 1) | (dd > length)
+    days = (first.astype(np.int64) + dd - 1).astype(np.float64)
+    return np.where(bad, np.nan, days), bad
+
+
+# The parsers below take the fields of many sentences of one type as
+# columns, fields[i] = field i of every sentence, and return
+# ({column: values}, malformed)
+
+def _log_gga(fields):
+    tod, bad = _log_floats(fields[1], required=True)
+    out = {'tod': _log_tod(tod)}
+    for c, (values, b) in (('lat', _log_latlon(fields[2], fields[3])),
+                           ('lon', _log_latlon(fields[4], fields[5])),
+                           ('fix', _log_floats(fields[6]))):
+        out[c] = values
+        bad = bad | b
+    return out, bad
+
+
+def _log_rmc(fields):
+    tod, bad = _log_floats(fields[1], required=True)
+    day, baddate = _log_date(fields[9])
+    out = {'tod': _log_tod(tod), 'day': day}
+    # position and motion of valid (status A) fixes only
+    active = np.array(fields[2], dtype=bytes) == b'A'
+    for c, (values, b) in (('lat', _log_latlon(fields[3], fields[4])),
+                           ('lon', _log_latlon(fields[5], fields[6])),
+                           ('speed', _log_floats(fields[7])),
+                           ('course', _log_floats(fields[8]))):
+        out[c] = np.where(active, values, np.nan)
+        bad = bad | (b & active)
+    return out, bad | baddate
+
+
+def _log_vtg(fields):
+    course, bad = _log_floats(fields[1])
+    speed, badspeed = _log_floats(fields[5])
+    return {'course': course, 'speed': speed}, bad | badspeed
+
+
+def _log_hdg(fields):
+    compass, bad = _log_floats(fields[1])
+    return {'compass': compass}, bad
+
+
+def _log_gsa(fields):
+    mode, bad = _log_floats(fields[2])
+    return {'mode': mode}, bad
+
+
+# column parsers of read_nmea_log by sentence id: (fields needed, parser)
+_LOG_PARSERS = {
+    b'GGA': (7, _log_gga),
+    b'RMC': (10, _log_rmc),
+    b'VTG': (6, _log_vtg),
+    b'HDG': (2, _log_hdg),
+    b'GSA': (3, _log_gsa),
+}
+
+
+def _parse_log_lines(lines):
+    """columns of one chunk of an NMEA log, one row per valid sentence:
+    (tod, day, {column: values}). tod is NaN for sentences without time,
+    day (days since 1970-01-01) is NaN for sentences without date.\n
+    Sentences of the same type and length are split in a single call and
+    parsed column by column, see _LOG_PARSERS."""
+    sentences, valid, stars = _checksums(lines)
+    bodies = [s[:star] for s, star, ok in
+              zip(sentences, stars.tolist(), valid.tolist()) if ok]
+    sids = np.array([b[3:6] for b in bodies], dtype=bytes)
+    nfields = np.array([b.count(b',') + 1 for b in bodies], dtype=np.int64)
+    out = dict((c, np.full(len(bodies), np.nan))
+               for c in ['tod', 'day'] + _LOG_COLUMNS)
+    keep = np.zeros(len(bodies), dtype=bool)
+    for sid, (needed, parser) in _LOG_PARSERS.items():
+        ofsid = sids == sid
+        for n in np.unique(nfields[ofsid & (nfields >= needed)]).tolist():
+            rows = np.flatnonzero(ofsid & (nfields == n))
+            flat = b','.join([bodies[i] for i in rows.tolist()]).split(b',')
+            columns, bad = parser([flat[i::n] for i in range(n)])
+            for c, values in columns.items():
+                out[c][rows] = values
+            keep[rows] = ~bad
+    return (out.pop('tod')[keep], out.pop('day')[keep],
+            dict((c, v[keep]) for c, v in out.items()))
+
+
+def _ffill_index(valid):
+    """index of the last valid row at or before each row (-1 if none)"""
+    idx = np.where(valid, np.arange(len(valid)), -1)
+    return np.maximum.accumulate(idx) if len(idx) else idx
+
+
+def read_nmea_log(path, chunksize=100000, processes=1, date=None):
+    """
+    Read an NMEA log (text, as logged from the serial port) into time
+    sorted columns, one row per fix time.
+
+    Sentences without a time (VTG, HDG, GSA) belong to the last timed
+    sentence (GGA, RMC) before them. The date is taken from the last RMC
+    sentence, with midnight rollovers of GGA times accounted for.
+    Rows with the same time are merged, later values taking precedence.
+
+    :param path: NMEA log file
+    :param chunksize: lines parsed at a time
+    :param processes: worker processes parsing chunks (None = one per
+        CPU, 1 = parse in the calling process)
+    :param date: date (datetime.date) of a log without RMC sentences
+
+    :return: dict of numpy arrays: time (POSIX seconds, UTC), lat, lon,
+        speed (knots), heading (compass if the log has HDG sentences,
+        else track made good), fix (GGA fix quality) and mode (GSA,
+        1 = none, 2 = 2D, 3 = 3D)
+    :rtype: dict
+    """
+    with open(path, 'rb') as f:
+        chunks = read_chunks(f, chunksize)
+        if processes == 1:
+            parsed = [_parse_log_lines(lines) for lines in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                depth = 2 * (processes or os.cpu_count() or 1)
+                parsed = list(ordered_map(pool, _parse_log_lines, chunks,
+                                          depth))
+    parsed = [p for p in parsed if len(p[0])] or [_parse_log_lines([])]
+    tod = np.concatenate([p[0] for p in parsed])
+    day = np.concatenate([p[1] for p in parsed])
+    cols = dict((c, np.concatenate([p[2][c] for p in parsed]))
+                for c in _LOG_COLUMNS)
+
+    # untimed sentences take the time of the preceding timed sentence
+    last = _ffill_index(~np.isnan(tod))
+    keep = last >= 0
+    tod = tod[last[keep]]
+    day = day[keep]
+    cols = dict((c, v[keep]) for c, v in cols.items())
+
+    # date of the last RMC, one day on if the time of day wrapped since
+    rmc = _ffill_index(~np.isnan(day))
+    if np.any(rmc >= 0):
+        first = np.flatnonzero(rmc >= 0)[0]
+        rmcday, rmctod = day[rmc], tod[rmc]
+        rmcday[:first], rmctod[:first] = day[first], tod[first]
+        rolled = np.where(tod < rmctod - 43200, 1, 0)
+        rolled[:first] = np.where(tod[:first] > tod[first] + 43200, -1, 0)
+        day = rmcday + rolled
+    elif date is not None:
+        day = np.full(len(tod), date.toordinal() - _EPOCH_ORDINAL, float)
+        rolled = np.concatenate([[0], np.diff(tod) < -43200]).cumsum()
+        day += rolled
+    elif len(tod):
+        raise ValueError("{0}: no RMC sentences, a date is required"
+                         .format(path))
+    times = day*86400 + tod
+
+    # sort by time and merge rows of the same time
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    starts = np.flatnonzero(np.diff(times, prepend=np.nan) != 0)
+    group = np.cumsum(np.diff(times, prepend=np.nan) != 0) - 1
+    out = {'time': times[starts]}
+    for c, values in cols.items():
+        values = values[order]
+        merged = np.full(len(starts), np.nan)
+        # last valid row of each group, later values take precedence
+        rows = np.flatnonzero(~np.isnan(values))
+        last = rows[np.diff(group[rows], append=np.inf) != 0]
+        merged[group[last]] = values[last]
+        out[c] = merged
+    # a compass (HDG) gives the heading, otherwise use track made good
+    if np.any(~np.isnan(out['compass'])):
+        out['heading'] = out['compass']
+    else:
+        out['heading'] = out['course']
+    del out['compass'], out['course']
+    return out
+
+
+def _or_nan(value):
+    return np.nan if value is None else value
+
+
+def _posix_times(times):
+    """datetime(s) or POSIX seconds to a float array"""
+    if isinstance(times, datetime.datetime):
+        return np.array([times.timestamp()])
+    times = np.atleast_1d(times)
+    if times.dtype == object:
+        return np.array([t.timestamp() if isinstance(t, datetime.datetime)
+                         else float(t) for t in times])
+    if np.issubdtype(times.dtype, np.datetime64):
+        return times.astype('datetime64[us]').astype(np.float64) / 1e6
+    return times.astype(np.float64)
+
+
+def interpolate_track(track_times, lat, lon, times, speed=None, heading=None,
+                      maxgap=None):
+    """
+    Interpolate a track (e.g. from read_nmea_log or the GPSManager
+    history) at arbitrary times, in O(log n) per time.
+
+    Longitudes are interpolated across the antimeridian and headings
+    along the shortest turn (as unit vectors).
+
+    :param track_times: sorted fix times, POSIX seconds
+    :param lat, lon: fix positions (degrees)
+    :param times: datetime(s) or POSIX seconds to interpolate at
+    :param speed, heading: optional fix speed and heading (degrees)
+    :param maxgap: maximum seconds between the fixes interpolated
+        (None = no limit)
+
+    :return: dict of arrays lat, lon and, if given, speed and heading
+        (NaN outside the track or across gaps)
+    :rtype: dict
+    """
+    t = np.asarray(track_times, dtype=np.float64)
+    x = _posix_times(times)
+    out = {}
+    if len(t) == 0:
+        for key, col in [('lat', lat), ('lon', lon), ('speed', speed),
+                         ('heading', heading)]:
+            if col is not None:
+                out[key] = np.full(len(x), np.nan)
+        return out
+    i = np.clip(np.searchsorted(t, x, side='right'), 1, max(len(t) - 1, 1))
+    i0, i1 = i - 1, np.minimum(i, len(t) - 1)
+    dt = t[i1] - t[i0]
+    w = np.where(dt > 0, (x - t[i0]) / np.where(dt > 0, dt, 1), 0.0)
+    outside = (x < t[0]) | (x > t[-1])
+    if maxgap is not None:
+        outside |= dt > maxgap
+
+    def lerp(col):
+        col = np.asarray(col, dtype=np.float64)
+        values = col[i0] + w*(col[i1] - col[i0])
+        values[outside] = np.nan
+        return values
+
+    out['lat'] = lerp(lat)
+    lon = np.asarray(lon, dtype=np.float64)
+    d = (lon[i1] - lon[i0] + 180.0) % 360.0 - 180.0  # shortest way round
+    out['lon'] = (lon[i0] + w*d + 180.0) % 360.0 - 180.0
+    out['lon'][outside] = np.nan
+    if speed is not None:
+        out['speed'] = lerp(speed)
+    if heading is not None:
+        rad = np.radians(np.asarray(heading, dtype=np.float64))
+        out['heading'] = np.degrees(np.arctan2(lerp(np.sin(rad)),
+                                               lerp(np.cos(rad)))) % 360.0
+    return out
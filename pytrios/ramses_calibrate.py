@@ -14,22 +14,147 @@ confusion with similar filenames or partial calibration info.
 @author: stsi
 """
 from __future__ import print_function  # hello future!
+import io
 import os
 import sys
+import json
+import bisect
 import numpy as np
 import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from ._utils import read_chunks, ordered_map
 
 
-def importCalFiles(CalFolder):
-    folders = os.listdir(CalFolder)
-    caldict = []
+def importCalFiles(CalFolder, cache=None, workers=None, pool='thread',
+                   errors=None):
+    """Import calibrations from the subfolders of *CalFolder*.\n
+    * cache = optional path of a binary (.npz) cache of parsed folders.
+    Folders whose files are unchanged (name, modification time, size)
+    are read from the cache, only changed folders are parsed again.
+    * workers = number of folders parsed concurrently (default: serial)
+    * pool = 'thread' (best for network shares) or 'process'
+    * errors = optional dict, filled with {folder: error message} for
+    folders that could not be imported. These are skipped, not fatal.\n
+    Calibrations are returned in folder name order.\n"""
+    folders = sorted(f for f in os.listdir(CalFolder)
+                     if os.path.isdir(os.path.join(CalFolder, f)))
+    cached = _loadCalCache(cache) if cache is not None else {}
+    updated = {}
+    signatures = {}
+    pending = []
     for f in folders:
-        cdct = _ProcessDatIniFiles(os.path.join(CalFolder, f))
-        if cdct:
-            caldict.append(cdct)
+        foldername = os.path.join(CalFolder, f)
+        signatures[foldername] = _folderSignature(foldername)
+        entry = cached.get(foldername)
+        if entry is not None and entry[0] == signatures[foldername]:
+            updated[foldername] = entry
+        else:
+            pending.append(foldername)
+    if workers is not None and workers > 1 and len(pending) > 1:
+        executor = {'thread': ThreadPoolExecutor,
+                    'process': ProcessPoolExecutor}[pool]
+        with executor(max_workers=workers) as ex:
+            futures = [(foldername, ex.submit(_ProcessDatIniFiles,
+                                              foldername))
+                       for foldername in pending]
+            results = [(foldername, _folderResult(fut.result))
+                       for foldername, fut in futures]
+    else:
+        results = [(foldername, _folderResult(_ProcessDatIniFiles,
+                                              foldername))
+                   for foldername in pending]
+    for foldername, (cdct, error) in results:
+        if error is not None:
+            print("Skipping calibration folder {0}: {1}"
+                  .format(foldername, error), file=sys.stderr)
+            if errors is not None:
+                errors[foldername] = error
+            continue  # not cached, a fixed folder is picked up next time
+        updated[foldername] = (signatures[foldername], cdct)
+    caldict = [updated[os.path.join(CalFolder, f)][1] for f in folders
+               if os.path.join(CalFolder, f) in updated]
+    caldict = [cdct for cdct in caldict if cdct]
+    if cache is not None and updated != cached:
+        _saveCalCache(cache, updated)
     return caldict
 
 
+def _folderResult(function, *args):
+    """(result, None) or (None, error message) of function(*args)"""
+    try:
+        return function(*args), None
+    except Exception as e:
+        return None, "{0}: {1}".format(type(e).__name__, e)
+
+
+def _folderSignature(foldername):
+    """(name, modification time, size) of every file in a folder"""
+    signature = []
+    for f in sorted(os.listdir(foldername)):
+        st = os.stat(os.path.join(foldername, f))
+        signature.append([f, st.st_mtime_ns, st.st_size])
+    return signature
+
+
+_CALSPECTRA = ['SAMspectrum_Aqua', 'SAMspectrum_Air',
+               'SAMspectrum_Back0', 'SAMspectrum_Back1']
+_CALDATES = ['SAMDateTime_Aqua', 'SAMDateTime_Air', 'SAMDateTime_Back']
+_CALDEVICES = ['SAMDevice_Aqua', 'SAMDevice_Air', 'SAMDevice_Back']
+
+
+def _loadCalCache(cache):
+    """read a calibration cache: {folder: (signature, Cal or None)}"""
+    entries = {}
+    if not os.path.exists(cache):
+        return entries
+    try:
+        with np.load(cache, allow_pickle=False) as npz:
+            folders = json.loads(str(npz['folders']))
+            for n, meta in enumerate(folders):
+                cal = None
+                if meta['cal'] is not None:
+                    cal = Cal()
+                    for key in _CALDEVICES:
+                        setattr(cal, key, meta['cal'][key])
+                    for key in _CALDATES:
+                        setattr(cal, key, datetime.datetime.strptime(
+                            meta['cal'][key], '%Y-%m-%d %H:%M:%S'))
+                    for key in _CALSPECTRA:
+                        setattr(cal, key, npz['{0}_{1}'.format(key, n)])
+                    cal.ini = Ini()
+                    for key, value in meta['cal']['ini'].items():
+                        setattr(cal.ini, key, value)
+                entries[meta['folder']] = (meta['signature'], cal)
+    except Exception as e:
+        print("Ignoring unreadable calibration cache {0}: {1}"
+              .format(cache, e), file=sys.stderr)
+        return {}
+    return entries
+
+
+def _saveCalCache(cache, entries):
+    """write {folder: (signature, Cal or None)} to a calibration cache"""
+    folders, arrays = [], {}
+    for n, (folder, (signature, cal)) in enumerate(sorted(entries.items())):
+        meta = {'folder': folder, 'signature': signature, 'cal': None}
+        if cal is not None:
+            meta['cal'] = dict((key, getattr(cal, key))
+                               for key in _CALDEVICES)
+            for key in _CALDATES:
+                meta['cal'][key] = getattr(cal, key)\
+                    .strftime('%Y-%m-%d %H:%M:%S')
+            meta['cal']['ini'] = vars(cal.ini)
+            for key in _CALSPECTRA:
+                arrays['{0}_{1}'.format(key, n)] = np.asarray(
+                    getattr(cal, key), dtype=np.float64)
+        folders.append(meta)
+    arrays['folders'] = np.array(json.dumps(folders))
+    tmp = cache + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, cache)  # never leave a half written cache behind
+
+
 class Ini(object):
     def __init__(self, DeviceType=None, SensorName=None,
                  SAMDevice=None, DeviceTypeSub1=None, DeviceTypeSub2=None,
@@ -53,11 +178,10 @@ def _ProcessDatIniFiles(foldername):
     CalAQ_SAM[****].dat contains calbration data for underwater measurements
     Back_SAM_[****].dat contains background information
     [****] is the module serial number"""
-    files = os.listdir(foldername)
-    calOut = None
+    files = sorted(os.listdir(foldername))
+    back, cal_air, cal_water = None, None, None
     inis = []  # allow parsing multiple .ini files
     for f in files:
-        out = ''
         if f.endswith('.dat'):
             print("\tparsing {0}".format(f), file=sys.stdout)
             out = _ParseDatFile(os.path.join(foldername, f))
@@ -72,58 +196,73 @@ def _ProcessDatIniFiles(foldername):
             print("\tparsing {0}".format(f), file=sys.stdout)
             iniOut = _ParseIniFile(os.path.join(foldername, f))
             inis.append(iniOut)
-        if len(inis) == 1:
-            ini = inis[0]
-        else:
-            for key in ['DeviceType', 'SensorName', 'SAMDevice',
-                        'IDDeviceTypeSub1', 'IDDeviceTypeSub2',
-                        'DarkPixelStart', 'DarkPixelStop', 'Reverse',
-                        'WavelengthRange',
-                        'c0s', 'c1s', 'c2s', 'c3s', 'cs']:
-                    n = [getattr(z, key) for z in inis if hasattr(z, key)]
-                    if len(n) > 0:
-                        setattr(ini, key, n[0])
-    if back and cal_air and cal_water and ini:
-        calOut = Cal()
-        calOut.SAMDevice_Aqua = cal_water['IDDevice']
-        calOut.SAMDevice_Air = cal_air['IDDevice']
-        calOut.SAMDevice_Back = back['IDDevice']
-        calOut.SAMDateTime_Aqua = cal_water['CalDateTime']
-        calOut.SAMDateTime_Air = cal_air['CalDateTime']
-        calOut.SAMDateTime_Back = back['CalDateTime']
-        calOut.SAMspectrum_Aqua = cal_water['spectrum0']
-        calOut.SAMspectrum_Air = cal_air['spectrum0']
-        calOut.SAMspectrum_Back0 = back['spectrum0']
-        calOut.SAMspectrum_Back1 = back['spectrum1']
-        calOut.ini = ini
+    if len(inis) == 1:
+        ini = inis[0]
+    elif len(inis) > 1:
+        ini = Ini()
+        for key in ['DeviceType', 'SensorName', 'SAMDevice',
+                    'DeviceTypeSub1', 'DeviceTypeSub2',
+                    'DarkPixelStart', 'DarkPixelStop', 'Reverse',
+                    'WavelengthRange',
+                    'c0s', 'c1s', 'c2s', 'c3s', 'cs']:
+            n = [getattr(z, key) for z in inis if hasattr(z, key)]
+            if len(n) > 0:
+                setattr(ini, key, n[0])
+    else:
+        ini = None
+    missing = [name for name, item in [('Back_SAM .dat', back),
+                                       ('Cal_SAM .dat', cal_air),
+                                       ('CalAQ_SAM .dat', cal_water),
+                                       ('.ini', ini)] if item is None]
+    if missing:
+        raise ValueError("incomplete calibration, missing {0}"
+                         .format(', '.join(missing)))
+    calOut = Cal()
+    calOut.SAMDevice_Aqua = cal_water['IDDevice']
+    calOut.SAMDevice_Air = cal_air['IDDevice']
+    calOut.SAMDevice_Back = back['IDDevice']
+    calOut.SAMDateTime_Aqua = cal_water['CalDateTime']
+    calOut.SAMDateTime_Air = cal_air['CalDateTime']
+    calOut.SAMDateTime_Back = back['CalDateTime']
+    calOut.SAMspectrum_Aqua = cal_water['spectrum0']
+    calOut.SAMspectrum_Air = cal_air['spectrum0']
+    calOut.SAMspectrum_Back0 = back['spectrum0']
+    calOut.SAMspectrum_Back1 = back['spectrum1']
+    calOut.ini = ini
     return calOut
 
 
 def _ParseDatFile(filename):
+    """parse a calibration .dat file, spectra are returned as arrays
+    (columns 2 and 3 of the [DATA] block, further columns are ignored)"""
     with open(filename, 'r') as f:
-        line = ''
-        IDDevice, TypeSub1, TypeSub2, CalDateTime = None, None, None, None
-        spectrum0, spectrum1 = [], []
-        while not line.startswith('[DATA]'):
-            line = f.readline()
-            if line.startswith('IDDevice'):
-                IDDevice = line.split('=')[1].strip().split('_')[1]  # serial n
-            if line.startswith('IDDataTypeSub1'):
-                TypeSub1 = line.split('=')[-1].upper().strip()  # BACK or CAL
-            if line.startswith('IDDataTypeSub2'):
-                TypeSub2 = line.split('=')[-1].upper().strip()  # AIR or AQUA
-            if line.startswith('DateTime'):
-                t = line.split('=')[-1].strip()
-                CalDateTime = datetime.datetime.strptime(t,
-                                                         '%Y-%m-%d %H:%M:%S')
-        line = f.readline()  # 1st line of data
-        while not line.startswith('[END] of [DATA]'):
-            spectrum0.append([float(i) for i in line.split()][1])
-            spectrum1.append([float(i) for i in line.split()][2])
-            line = f.readline()
-        outdict = {'IDDevice': IDDevice, 'IDDataTypeSub1': TypeSub1,
-                   'IDDataTypeSub2': TypeSub2, 'CalDateTime': CalDateTime,
-                   'spectrum0': spectrum0, 'spectrum1': spectrum1}
+        text = f.read()  # universal newlines, CRLF is read as LF
+    start = text.find('\n[DATA]')
+    if start < 0:
+        start = text.find('[DATA]')  # no header at all
+        header = ''
+    else:
+        header = text[:start]
+    datastart = text.find('\n', start + 1) + 1
+    dataend = text.find('\n[END] of [DATA]', datastart - 1)
+    if start < 0 or datastart == 0 or dataend < 0:
+        raise ValueError("{0}: no [DATA] block found".format(filename))
+    IDDevice, TypeSub1, TypeSub2, CalDateTime = None, None, None, None
+    for line in header.split('\n'):
+        if line.startswith('IDDevice'):
+            IDDevice = line.split('=')[1].strip().split('_')[1]  # serial n
+        if line.startswith('IDDataTypeSub1'):
+            TypeSub1 = line.split('=')[-1].upper().strip()  # BACK or CAL
+        if line.startswith('IDDataTypeSub2'):
+            TypeSub2 = line.split('=')[-1].upper().strip()  # AIR or AQUA
+        if line.startswith('DateTime'):
+            t = line.split('=')[-1].strip()
+            CalDateTime = datetime.datetime.strptime(t, '%Y-%m-%d %H:%M:%S')
+    data = np.loadtxt(io.StringIO(text[datastart:dataend]), usecols=(1, 2),
+                      ndmin=2)
+    outdict = {'IDDevice': IDDevice, 'IDDataTypeSub1': TypeSub1,
+               'IDDataTypeSub2': TypeSub2, 'CalDateTime': CalDateTime,
+               'spectrum0': data[:, 0], 'spectrum1': data[:, 1]}
     return outdict
 
 
@@ -180,6 +319,326 @@ def _ParseIniFile(filename):
         return iniOut
 
 
+def _wavelengths(ini):
+    """pixel wavelengths from the ini file polynomial coefficients"""
+    n = np.arange(2, 258, dtype=np.float64)  # pixel numbering as per TriOS
+    return ini.c0s + ini.c1s*n + ini.c2s*n**2 + ini.c3s*n**3
+
+
+def _interp_weights(wave, wlOut):
+    """indices and weights reproducing np.interp(wlOut, wave, F)"""
+    wlOut = np.asarray(wlOut, dtype=np.float64)
+    idx = np.searchsorted(wave, wlOut, side='right') - 1
+    idx = np.clip(idx, 0, len(wave) - 2)
+    w = (wlOut - wave[idx]) / (wave[idx+1] - wave[idx])
+    return idx, np.clip(w, 0.0, 1.0)
+
+
+# Sentinel-3 OLCI bands as (name, centre, width) in nm
+OLCI_BANDS = [('Oa1', 400.0, 15.0), ('Oa2', 412.5, 10.0),
+              ('Oa3', 442.5, 10.0), ('Oa4', 490.0, 10.0),
+              ('Oa5', 510.0, 10.0), ('Oa6', 560.0, 10.0),
+              ('Oa7', 620.0, 10.0), ('Oa8', 665.0, 10.0),
+              ('Oa9', 673.75, 7.5), ('Oa10', 681.25, 7.5),
+              ('Oa11', 708.75, 10.0), ('Oa12', 753.75, 7.5),
+              ('Oa13', 761.25, 2.5), ('Oa14', 764.375, 3.75),
+              ('Oa15', 767.5, 2.5), ('Oa16', 778.75, 15.0),
+              ('Oa17', 865.0, 20.0), ('Oa18', 885.0, 10.0),
+              ('Oa19', 900.0, 10.0), ('Oa20', 940.0, 20.0),
+              ('Oa21', 1020.0, 40.0)]
+
+
+class ResamplingPlan(object):
+    """Resampling of spectra from a sensor wavelength grid, prepared once
+    and applied to any number of spectra.\n
+    * wave = sensor pixel wavelengths (increasing)\n
+    * wlOut = output wavelength grid, for linear interpolation\n
+    * bands = sequence of (name, centre, width) to average the spectrum
+    over band spectral response functions instead, e.g. OLCI_BANDS\n
+    * srf = band response shape, 'boxcar' (width = full width) or
+    'gaussian' (width = FWHM)\n
+    * step = sampling interval (nm) used to integrate the band responses\n
+    Band averaging is a single matrix multiply, (N x pixels) @ matrix.
+    Bands whose response is not fully covered by *wave* are NaN, see
+    *covered*."""
+    def __init__(self, wave, wlOut=None, bands=None, srf='boxcar',
+                 step=0.1):
+        self.wave = np.asarray(wave, dtype=np.float64)
+        if bands is None:
+            self.method = 'linear'
+            self.names = None
+            self.wlOut = np.asarray(wlOut, dtype=np.float64)
+            self.idx, self.w = _interp_weights(self.wave, self.wlOut)
+            self._matrix = None
+            self.covered = np.ones(len(self.wlOut), dtype=bool)
+        else:
+            self.method = 'band'
+            self.names = [b[0] for b in bands]
+            self.wlOut = np.array([b[1] for b in bands], dtype=np.float64)
+            self.idx, self.w = None, None
+            self.covered = np.ones(len(bands), dtype=bool)
+            self._matrix = self._band_matrix(bands, srf, step)
+        if self.method == 'linear':
+            # the dense matrix is only built on request
+            used = np.concatenate([self.idx[self.w < 1],
+                                   self.idx[self.w > 0] + 1])
+        else:
+            used = np.flatnonzero(self._matrix.any(axis=1))
+        if len(used):  # pixels with weight
+            self.pixels = slice(int(used.min()), int(used.max()) + 1)
+        else:
+            self.pixels = slice(0, 0)
+        if self.method == 'band':
+            self._used = self._matrix[self.pixels]
+
+    def _band_matrix(self, bands, srf, step):
+        """(pixels x bands) weights: the band response integrated over the
+        linearly interpolated spectrum, normalised to unit sum. Bands
+        reaching beyond the sensor grid get no weights and are marked in
+        *covered*."""
+        matrix = np.zeros((len(self.wave), len(bands)))
+        for j, (name, centre, width) in enumerate(bands):
+            if srf == 'boxcar':
+                n = max(int(np.ceil(width/step)), 1)
+                x = centre + width*((np.arange(n) + 0.5)/n - 0.5)
+                r = np.ones(n)
+            elif srf == 'gaussian':
+                sigma = width/(2*np.sqrt(2*np.log(2)))
+                x = np.arange(centre - 3*sigma, centre + 3*sigma, step)
+                r = np.exp(-0.5*((x - centre)/sigma)**2)
+            else:
+                raise ValueError("unknown srf {0}".format(srf))
+            edges = (centre - width/2.0, centre + width/2.0) \
+                if srf == 'boxcar' else (x[0], x[-1])
+            if edges[0] < self.wave[0] or edges[1] > self.wave[-1]:
+                self.covered[j] = False  # would extrapolate the edge pixel
+                continue
+            idx, w = _interp_weights(self.wave, x)
+            np.add.at(matrix[:, j], idx, r*(1 - w))
+            np.add.at(matrix[:, j], idx + 1, r*w)
+            matrix[:, j] /= r.sum()
+        return matrix
+
+    @property
+    def matrix(self):
+        """(pixels x outputs) resampling matrix"""
+        if self._matrix is None:
+            cols = np.arange(len(self.wlOut))
+            m = np.zeros((len(self.wave), len(self.wlOut)))
+            np.add.at(m, (self.idx, cols), 1 - self.w)
+            np.add.at(m, (self.idx + 1, cols), self.w)
+            self._matrix = m
+        return self._matrix
+
+    def apply(self, F):
+        """resample spectra *F* (... x pixels) to (... x outputs)"""
+        F = np.asarray(F, dtype=np.float64)
+        if self.method == 'linear':
+            Fl, Fr = F[..., self.idx], F[..., self.idx+1]
+            return Fl + self.w*(Fr - Fl)
+        # only pixels with weight, a NaN elsewhere must not spread
+        out = F[..., self.pixels] @ self._used
+        out[..., ~self.covered] = np.nan
+        return out
+
+
+# rows of _CalKernel.S, 'background' only corrects for background and
+# dark offset (no radiometric scaling)
+MEDIA = {'air': 0, 'aqua': 1, 'background': 2}
+
+
+def _medium(m):
+    return MEDIA['background' if m is None else m.lower()]
+
+
+def _media(medium, n):
+    """medium name (None = 'background') or sequence of names to row
+    indices into _CalKernel.S"""
+    if medium is None or isinstance(medium, str):
+        return np.full(n, _medium(medium))
+    return np.array([_medium(m) for m in medium])
+
+
+class _CalKernel(object):
+    """arrays of a single calibration, prepared once for repeated use"""
+    def __init__(self, Cal, wlOut, bands=None, srf='boxcar'):
+        self.Cal = Cal
+        self.B0 = np.asarray(Cal.SAMspectrum_Back0, dtype=np.float64)
+        self.B1 = np.asarray(Cal.SAMspectrum_Back1, dtype=np.float64)
+        # calibration spectra in air and water, see MEDIA
+        self.S = np.full((len(MEDIA), 256), np.nan)
+        self.S[MEDIA['air']] = Cal.SAMspectrum_Air
+        if getattr(Cal, 'SAMspectrum_Aqua', None) is not None:
+            self.S[MEDIA['aqua']] = Cal.SAMspectrum_Aqua
+        self.S[MEDIA['background']] = 1.0
+        self.dark = slice(Cal.ini.DarkPixelStart - 1, Cal.ini.DarkPixelStop)
+        self.wave = _wavelengths(Cal.ini)
+        self.plan = ResamplingPlan(self.wave, wlOut, bands, srf)
+
+    def apply(self, M, t1, media, immersion=None):
+        """calibrate normalised spectra *M* (N x 256) with integration
+        times *t1* (N, in ms) in *media* (N, see MEDIA), optionally
+        multiplied by *immersion* factors. Returns (N x len(wlOut))"""
+        t0 = 8192
+        t1 = np.asarray(t1, dtype=np.float64)[:, None]
+        # scale Background cal data to integration time
+        B = self.B0 + (t1/t0*self.B1)
+        C = M - B
+        # subtract dark offset,
+        Offset = C[:, self.dark].mean(axis=1)  # dark pixels
+        D = C - Offset[:, None]
+        E = D*(t0/t1)
+        # Scale the spectrum to the Air or Aqua calibration
+        F = E/self.S[media]
+        if immersion is not None:
+            radiometric = (media != MEDIA['background'])[:, None]
+            F = np.where(radiometric, F*immersion, F)
+        # resample spectrum to the output grid
+        return self.plan.apply(F)
+
+
+def _normalise(specs):
+    """raw spectra (N x <=256) to normalised counts and integration time"""
+    specs = np.atleast_2d(np.asarray(specs))
+    M = np.full((specs.shape[0], 256), np.nan)
+    M[:, 0:specs.shape[1]] = specs/float(65535)
+    msintt = 2*2**(specs[:, 0].astype(np.int64) & 0b1111)
+    return M, msintt
+
+
+class CalIndex(object):
+    """Time index of the calibrations of each sensor.\n
+    A measurement uses the most recent calibration at or before the
+    measurement time. Measurements that predate all calibrations of a
+    sensor use its earliest calibration.\n
+    * CalData = set of calibration data\n"""
+    def __init__(self, CalData):
+        bysensor = {}
+        for i, c in enumerate(CalData):
+            bysensor.setdefault(c.ini.SensorName, []).append(
+                (c.SAMDateTime_Air, i))
+        self._dates = {}  # serial number: sorted calibration datetimes
+        self._dates64 = {}  # same as datetime64 array
+        self._indices = {}  # serial number: CalData indices, same order
+        for sn, entries in bysensor.items():
+            entries.sort()
+            self._dates[sn] = [d for d, i in entries]
+            self._dates64[sn] = np.array(self._dates[sn],
+                                         dtype='datetime64[us]')
+            self._indices[sn] = np.array([i for d, i in entries])
+
+    def sensors(self):
+        return sorted(self._dates.keys())
+
+    def select(self, serialn, msdate):
+        """index into CalData of the calibration for a measurement.
+        Raises KeyError if the sensor has no calibration."""
+        dates = self._dates[serialn]
+        i = max(bisect.bisect_right(dates, msdate) - 1, 0)
+        return int(self._indices[serialn][i])
+
+    def select_many(self, serialn, msdates):
+        """indices into CalData for a sequence of measurement times"""
+        msdates = np.asarray(msdates, dtype='datetime64[us]')
+        i = np.searchsorted(self._dates64[serialn], msdates, side='right')
+        return self._indices[serialn][np.maximum(i - 1, 0)]
+
+    def epochs(self, serialn):
+        """calibration epochs of a sensor as (start, end, index) with
+        index into CalData, valid for start <= time < end. The first
+        epoch starts at None and the last one ends at None."""
+        dates = self._dates[serialn]
+        starts = [None] + dates[1:]
+        ends = dates[1:] + [None]
+        return [(s, e, int(i)) for s, e, i in
+                zip(starts, ends, self._indices[serialn])]
+
+
+class Calibrator(object):
+    """Calibrates raw SAM spectra IN AIR, see raw2cal_Air.\n
+    Calibration arrays, wavelengths and resampling weights are computed
+    once per calibration and reused for every spectrum.\n
+    * CalData = set of calibration data (see importCalFiles)\n
+    * wlOut = output wavelength grid (numpy arange)\n
+    * bands = optional (name, centre, width) bands, e.g. OLCI_BANDS, to
+    output band averages instead of wlOut, see ResamplingPlan\n
+    * srf = band response shape, 'boxcar' or 'gaussian'\n"""
+    def __init__(self, CalData, wlOut=np.arange(320, 955, 3.3), bands=None,
+                 srf='boxcar'):
+        self.CalData = CalData
+        self.bands, self.srf = bands, srf
+        if bands is None:
+            self.wlOut = np.asarray(wlOut, dtype=np.float64)
+        else:
+            self.wlOut = np.array([b[1] for b in bands], dtype=np.float64)
+        self.index = CalIndex(CalData)
+        self._kernels = {}  # index into CalData: _CalKernel
+
+    def select(self, serialn, msdate):
+        """index into CalData of the calibration for a measurement"""
+        return self.index.select(serialn, msdate)
+
+    def kernel(self, index):
+        try:
+            return self._kernels[index]
+        except KeyError:
+            k = _CalKernel(self.CalData[index], self.wlOut, self.bands,
+                           self.srf)
+            self._kernels[index] = k
+            return k
+
+    def calibrate(self, spec, msdate, serialn, medium='air',
+                  immersion=None):
+        """calibrate a single raw spectrum (list or array of int).\n
+        *medium* = 'air', 'aqua' (underwater calibration) or None for
+        background and dark corrected counts only\n
+        *immersion* = optional immersion factor(s), scalar or per pixel,
+        applied on top of the selected calibration"""
+        M, msintt = _normalise(spec)
+        kernel = self.kernel(self.select(serialn, msdate))
+        return kernel.apply(M, msintt, _media(medium, 1), immersion)[0]
+
+    def calibrate_batch(self, specs, msdates, serialn, medium='air',
+                        immersion=None):
+        """calibrate stacked raw spectra (N x 256) from one sensor.\n
+        *msdates* = a single datetime or one per spectrum\n
+        *medium* = 'air', 'aqua' or None (background corrected only), or
+        one per spectrum, so spectra taken above and below water can be
+        calibrated in a single batch\n
+        *immersion* = optional immersion factor(s), scalar or per pixel\n
+        Returns an (N x len(wlOut)) array."""
+        M, msintt = _normalise(specs)
+        media = _media(medium, M.shape[0])
+        if isinstance(msdates, datetime.datetime):
+            selected = np.full(M.shape[0], self.select(serialn, msdates))
+        else:
+            selected = self.index.select_many(serialn, msdates)
+        out = np.empty((M.shape[0], len(self.wlOut)))
+        for index in np.unique(selected):
+            rows = selected == index
+            out[rows] = self.kernel(index).apply(M[rows], msintt[rows],
+                                                 media[rows], immersion)
+        return out
+
+
+_calibrators = {}  # Calibrators of the raw2cal functions, see below
+
+
+def _cachedCalibrator(CalData, wlOut, maxsize=8):
+    """Calibrator for CalData and wlOut, kept for the next call with the
+    same CalData (object and length) and wlOut. A CalData changed in place
+    otherwise needs a new list, or a Calibrator of its own."""
+    wlOut = np.asarray(wlOut, dtype=np.float64)
+    key = (id(CalData), len(CalData), wlOut.tobytes())
+    cached = _calibrators.get(key)
+    if cached is None or cached[0] is not CalData:
+        if len(_calibrators) >= maxsize:
+            _calibrators.clear()
+        cached = (CalData, Calibrator(CalData, wlOut))
+        _calibrators[key] = cached
+    return cached[1]
+
+
 def raw2cal_Air(spec, msdate, serialn,
                 CalData, wlOut=np.arange(320, 955, 3.3)):
     """Calibration IN AIR according to Trios manual, page 13+
@@ -187,46 +646,142 @@ def raw2cal_Air(spec, msdate, serialn,
     * msdate = measurement datetime\n
     * serialn = module serial number\n
     * CalData = set of calibration data\n
-    * wlOut = output wavelength grid (numpy arange)\n"""
-
-    SAMDateTime_Air = [i.SAMDateTime_Air for i in CalData]
-    iniSensorName = [i.ini.SensorName for i in CalData]
-    out = [np.nan]*len(wlOut)
-    msintt = 2*2**(spec[0] & 0b1111)
-    # find best calibration match
-    calsensind = [i for i, j in enumerate(iniSensorName) if j == serialn]
-    # pick most recent (never in future, in case of sensor repair)
-    if len(calsensind) > 1:
-        calsensdates = [SAMDateTime_Air[i] for i in calsensind]
-        tdeltas = [(msdate-x) for x in calsensdates
-                   if (msdate-x).days > 0]
-        calsensind = [calsensind[tdeltas.index(min(tdeltas))]]
-
-    Cal = CalData[calsensind[0]]
-    B0 = np.array(Cal.SAMspectrum_Back0)
-    B1 = np.array(Cal.SAMspectrum_Back1)
-    S = np.array(Cal.SAMspectrum_Air)
-    dp1 = Cal.ini.DarkPixelStart
-    dp2 = Cal.ini.DarkPixelStop
-    wave = [0.0] * 256
-    for i in range(1, len(wave)+1, 1):
-        wave[i-1] = (Cal.ini.c0s) + (Cal.ini.c1s*(i+1)) +\
-            (Cal.ini.c2s*(i+1)**2) + (Cal.ini.c3s*(i+1)**3)
-
-    t0 = 8192
-    t1 = msintt  # in ms
-    # pad array with nans and fill with normalized RawData
-    M = np.array([np.nan]*256)
-    M[0:len(spec)] = np.array(spec)/float(65535)
-    # scale Background cal data to integration time
-    B = B0 + (t1/t0*B1)
-    C = M - B
-    # subtract dark offset,
-    Offset = np.mean(C[dp1-1:dp2])  # dark pixels
-    D = C-Offset
-    E = D*(t0/t1)
-    # Scale the spectrum to the Air calibration
-    F = E/S
-    # resample spectrum to a strict 3.3 nm grid
-    out = np.interp(wlOut, wave, F)
-    return out
+    * wlOut = output wavelength grid (numpy arange)\n
+    The Calibrator of CalData and wlOut is prepared on the first call and
+    reused, see _cachedCalibrator."""
+    return _cachedCalibrator(CalData, wlOut).calibrate(spec, msdate, serialn)
+
+
+def raw2cal_Aqua(spec, msdate, serialn,
+                 CalData, wlOut=np.arange(320, 955, 3.3)):
+    """Calibration IN WATER according to Trios manual, page 13+
+    * spec = raw spectrum (list of int)\n
+    * msdate = measurement datetime\n
+    * serialn = module serial number\n
+    * CalData = set of calibration data\n
+    * wlOut = output wavelength grid (numpy arange)\n
+    The Calibrator of CalData and wlOut is prepared on the first call and
+    reused, see _cachedCalibrator."""
+    return _cachedCalibrator(CalData, wlOut).calibrate(
+        spec, msdate, serialn, medium='aqua')
+
+
+def raw2cal(spec, msdate, serialn, CalData,
+            wlOut=np.arange(320, 955, 3.3), medium='air', immersion=None):
+    """Calibration in air or water with optional immersion factors, or
+    background correction only
+    * spec = raw spectrum (list of int)\n
+    * msdate = measurement datetime\n
+    * serialn = module serial number\n
+    * CalData = set of calibration data\n
+    * wlOut = output wavelength grid (numpy arange)\n
+    * medium = 'air' or 'aqua', selects the calibration spectrum. None
+    returns the background and dark corrected spectrum, normalised to
+    8192 ms, without radiometric scaling\n
+    * immersion = immersion factor(s), scalar or per pixel, e.g. to
+    calibrate underwater data with the air calibration\n
+    The Calibrator of CalData and wlOut is prepared on the first call and
+    reused, see _cachedCalibrator."""
+    return _cachedCalibrator(CalData, wlOut).calibrate(
+        spec, msdate, serialn, medium, immersion)
+
+
+_worker_calibrator = None  # Calibrator of a calibrateRawFile worker process
+_worker_medium = 'air'
+_WORKER = object()  # use the worker process calibrator or medium
+
+
+def _init_worker(CalData, wlOut, medium='air', bands=None):
+    global _worker_calibrator, _worker_medium
+    _worker_calibrator = Calibrator(CalData, wlOut, bands)
+    _worker_medium = medium
+
+
+def _calibrate_lines(lines, calibrator=_WORKER, medium=_WORKER):
+    """calibrate raw log lines, return (output text, rows written,
+    rows skipped). *medium* may be None (background corrected only), so
+    the worker defaults are marked with _WORKER"""
+    if calibrator is _WORKER:
+        calibrator = _worker_calibrator
+    if medium is _WORKER:
+        medium = _worker_medium
+    rows, counts, dates = [], [], []
+    for line in lines:
+        r = line.strip().split(',', 3)
+        if len(r) != 4:
+            continue
+        try:
+            c = [int(v) for v in r[3].split(',')]
+            d = datetime.datetime.fromisoformat(r[0])
+        except ValueError:
+            continue  # corrupt timestamp or counts
+        if len(c) == 256:
+            rows.append(r)
+            counts.append(c)
+            dates.append(d)
+    skipped = len(lines) - len(rows)
+    if not rows:
+        return '', 0, skipped
+    specs = np.array(counts, dtype=np.int64)
+    serials = np.array([r[1] for r in rows])
+    out = np.full((len(rows), len(calibrator.wlOut)), np.nan)
+    for sn in np.unique(serials):
+        sel = np.flatnonzero(serials == sn)
+        try:
+            out[sel] = calibrator.calibrate_batch(specs[sel],
+                                                  [dates[i] for i in sel], sn,
+                                                  medium)
+        except (KeyError, ValueError, IndexError):
+            print("No calibration for sensor {0}".format(sn),
+                  file=sys.stderr)
+    text = []
+    for r, cal in zip(rows, out):
+        if np.isnan(cal).all():
+            skipped += 1
+            continue
+        text.append(",".join([r[0], r[1], r[2],
+                              ",".join(str(v) for v in cal.tolist())]))
+    written = len(text)
+    if text:
+        text.append('')  # closing newline
+    return '\n'.join(text), written, skipped
+
+
+def calibrateRawFile(rawfile, calfile, CalData,
+                     wlOut=np.arange(320, 955, 3.3), chunksize=10000,
+                     processes=None, medium='air', bands=None):
+    """Calibrate a raw log file, streaming it in chunks.\n
+    * rawfile = raw log, rows of: timestamp, serial number, integration
+    time, 256 raw counts (as written by Rrs_example -rawout)\n
+    * calfile = output file, same layout with calibrated values on the
+    wlOut grid (as Rrs_example -calout), appended to\n
+    * CalData = set of calibration data\n
+    * chunksize = rows per chunk, each chunk is calibrated as a matrix per
+    sensor and calibration\n
+    * processes = number of worker processes (None = one per CPU,
+    1 = calibrate in the calling process)\n
+    * medium = 'air', 'aqua' or None (background corrected only)\n
+    * bands = optional (name, centre, width) bands, e.g. OLCI_BANDS, to
+    write band averages instead of the wlOut grid\n
+    Chunks are written in input order. Returns (rows written, rows
+    skipped), rows are skipped when malformed or not calibrated."""
+    written, skipped = 0, 0
+    with open(rawfile, 'r') as fin, open(calfile, 'a+') as fout:
+        chunks = read_chunks(fin, chunksize)
+        if processes == 1:
+            calibrator = Calibrator(CalData, wlOut, bands)
+            for lines in chunks:
+                text, n, nskip = _calibrate_lines(lines, calibrator, medium)
+                fout.write(text)
+                written, skipped = written + n, skipped + nskip
+            return written, skipped
+        initargs = (CalData, wlOut, medium, bands)
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_worker,
+                                 initargs=initargs) as pool:
+            depth = 2 * (processes or os.cpu_count() or 1)
+            for text, n, nskip in ordered_map(pool, _calibrate_lines,
+                                              chunks, depth):
+                fout.write(text)
+                written, skipped = written + n, skipped + nskip
+    return written, skipped
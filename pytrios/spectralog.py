@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+"""
+Binary logging of raw and calibrated spectra
+
+Spectra are stored row by row, one record per spectrum, in a standard .npy
+file with a structured dtype:\n
+    time     = float64, POSIX seconds (PC clock)
+    serial   = 8 byte sensor serial number
+    inttime  = uint16, integration time in ms
+    spectrum = uint16 (raw counts) or float32 (calibrated) per pixel\n
+The header is padded so the record count can be rewritten in place after
+each flush. Records are always appended after the last complete record and
+the reader derives the record count from the file size, so a file is
+readable (up to the last completed flush) after a crash or power loss.
+Output wavelengths of calibrated spectra are kept in a '.wl.npy' sidecar.
+
+The time, serial and inttime fields are also written to a '.idx.npy'
+sidecar of 18 byte records, in the same layout. SpectraArchive builds its
+time index from this file, so it does not read the spectra (~530 bytes per
+raw record). The sidecar is rebuilt from the log when a SpectraWriter
+finds it missing or short.
+
+Files can be read with numpy.load(path, mmap_mode='r') or loadSpectra.
+
+AsyncSpectraWriter moves formatting and writing (binary or text) to a
+background thread, so a slow disk does not hold up acquisition.
+"""
+import io
+import os
+import sys
+import time
+import queue
+import datetime
+import threading
+import numpy as np
+from ._utils import put_drop_oldest
+
+_MAGIC = b'\x93NUMPY\x01\x00'  # .npy format version 1.0
+_SHAPE_DIGITS = 21  # room to rewrite the record count in place
+
+
+def spectraDtype(width=256, dtype=np.uint16):
+    """record dtype for spectra of *width* pixels of *dtype*"""
+    return np.dtype([('time', '<f8'), ('serial', 'S8'), ('inttime', '<u2'),
+                     ('spectrum', np.dtype(dtype).newbyteorder('<'),
+                      (width,))])
+
+
+def _header(dtype, nrows, size=None):
+    """.npy header for *nrows* records, padded to *size* bytes (or to the
+    smallest multiple of 64 that leaves room for any record count)"""
+    descr = np.lib.format.dtype_to_descr(dtype)
+    text = "{{'descr': {0!r}, 'fortran_order': False, 'shape': ({1},), }}"\
+        .format(descr, nrows)
+    if size is None:
+        minimum = len(_MAGIC) + 2 + len(text) + _SHAPE_DIGITS + 1
+        size = -(-minimum // 64) * 64
+    text = text.ljust(size - len(_MAGIC) - 3) + '\n'
+    if len(_MAGIC) + 2 + len(text) != size:
+        raise ValueError("record count does not fit the file header")
+    return _MAGIC + np.array(len(text), '<u2').tobytes() +\
+        text.encode('latin1')
+
+
+def _readHeader(f):
+    """(dtype, header size) of an open .npy file of records"""
+    f.seek(0)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+    if len(shape) != 1 or dtype.names is None:
+        raise ValueError("{0} is not a spectra log".format(f.name))
+    return dtype, f.tell()
+
+
+def _posix(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.timestamp()
+    return float(timestamp)
+
+
+# fields of the index sidecar
+_INDEX_DTYPE = np.dtype([('time', '<f8'), ('serial', 'S8'),
+                         ('inttime', '<u2')])
+
+
+class _RecordFile(object):
+    """.npy file of records that is appended to in place, see
+    SpectraWriter"""
+    def __init__(self, path, dtype, fsync=True):
+        self.path = path
+        self.dtype = dtype
+        self.fsync = fsync
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.f = open(path, 'r+b')
+            dtype, self.headersize = _readHeader(self.f)
+            if dtype != self.dtype:
+                self.f.close()
+                raise ValueError("{0} holds records of {1}, not {2}"
+                                 .format(path, dtype, self.dtype))
+            # drop a record that was partly written when logging stopped
+            self.truncate((os.path.getsize(path) - self.headersize)
+                          // self.dtype.itemsize)
+        else:
+            self.f = open(path, 'w+b')
+            self.rows = 0
+            header = _header(self.dtype, 0)
+            self.headersize = len(header)
+            self.f.write(header)
+            self.sync()
+
+    def truncate(self, rows):
+        self.rows = rows
+        self.f.truncate(self.headersize + rows*self.dtype.itemsize)
+
+    def append(self, records):
+        """write records after the last complete one, then update the
+        record count"""
+        if len(records) == 0:
+            return
+        self.f.seek(self.headersize + self.rows*self.dtype.itemsize)
+        self.f.write(records.tobytes())
+        self.sync()  # records are on disk before the header counts them
+        self.rows += len(records)
+        self.f.seek(0)
+        self.f.write(_header(self.dtype, self.rows, self.headersize))
+        self.sync()
+
+    def sync(self):
+        self.f.flush()
+        if self.fsync:
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
+
+
+class SpectraWriter(object):
+    """Appends spectra to a binary (.npy) log of records.\n
+    * path = output file, appended to if it exists (same layout only)\n
+    * width = pixels per spectrum\n
+    * dtype = np.uint16 for raw spectra, np.float32 for calibrated ones\n
+    * wavelengths = optional wavelength grid, saved as path + '.wl.npy'\n
+    * buffersize = records held in memory between flushes\n
+    * fsync = force flushed records to disk (survives power loss)\n
+    The index sidecar (path + '.idx.npy') is written along with the log.
+    Use as a context manager or call close() to write the last records."""
+    def __init__(self, path, width=256, dtype=np.uint16, wavelengths=None,
+                 buffersize=1000, fsync=True):
+        self.path = path
+        self.dtype = spectraDtype(width, dtype)
+        self.buffer = np.zeros(max(int(buffersize), 1), dtype=self.dtype)
+        self.pending = 0  # records in buffer
+        self.log = _RecordFile(path, self.dtype, fsync)
+        self.f = self.log.f
+        try:
+            self.index = _RecordFile(indexPath(path), _INDEX_DTYPE, fsync)
+        except ValueError:
+            self.log.close()
+            raise
+        self._completeIndex()
+        if wavelengths is not None:
+            np.save(wavelengthPath(path),
+                    np.asarray(wavelengths, dtype=np.float64))
+
+    def _completeIndex(self):
+        """match the index to the log, e.g. a log written without index or
+        a crash between writing the log and the index"""
+        if self.index.rows > self.log.rows:
+            self.index.truncate(self.log.rows)
+        if self.index.rows == self.log.rows:
+            return
+        records = loadSpectra(self.path)
+        chunk = 100000
+        for a in range(self.index.rows, self.log.rows, chunk):
+            self.index.append(_indexRecords(records[a:a + chunk]))
+
+    @property
+    def rows(self):
+        return self.log.rows
+
+    def append(self, spectrum, timestamp, serialn, inttime=0):
+        """add a spectrum, *timestamp* is a datetime or POSIX seconds"""
+        rec = self.buffer[self.pending]
+        rec['time'] = _posix(timestamp)
+        rec['serial'] = serialn
+        rec['inttime'] = inttime
+        rec['spectrum'] = spectrum
+        self.pending += 1
+        if self.pending == len(self.buffer):
+            self.flush()
+
+    def append_many(self, spectra, timestamps, serialn, inttimes=0):
+        """add stacked spectra (N x width). *timestamps*, *serialn* and
+        *inttimes* are single values or one per spectrum"""
+        spectra = np.atleast_2d(spectra)
+        n = spectra.shape[0]
+        if isinstance(timestamps, datetime.datetime) or np.isscalar(
+                timestamps):
+            timestamps = [timestamps]*n
+        records = np.zeros(n, dtype=self.dtype)
+        records['time'] = [_posix(t) for t in timestamps]
+        records['serial'] = serialn
+        records['inttime'] = inttimes
+        records['spectrum'] = spectra
+        self.write(records)
+
+    def write(self, records):
+        """add an array of records of the log dtype"""
+        start = 0
+        while start < len(records):
+            n = min(len(records) - start, len(self.buffer) - self.pending)
+            self.buffer[self.pending:self.pending + n] = \
+                records[start:start + n]
+            self.pending += n
+            start += n
+            if self.pending == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        """write buffered records to the log, then to the index"""
+        if self.pending == 0:
+            return
+        records = self.buffer[:self.pending]
+        self.log.append(records)
+        self.index.append(_indexRecords(records))
+        self.pending = 0
+
+    def sync(self):
+        """force written records to disk"""
+        for f in (self.log.f, self.index.f):
+            os.fsync(f.fileno())
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.log.close()
+            self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.rows + self.pending
+
+    def __repr__(self):
+        return "<PyTrios SpectraWriter: {0}, {1} records, {2} buffered>"\
+            .format(self.path, self.rows, self.pending)
+
+
+def _indexRecords(records):
+    index = np.zeros(len(records), dtype=_INDEX_DTYPE)
+    for name in _INDEX_DTYPE.names:
+        index[name] = records[name]
+    return index
+
+
+def wavelengthPath(path):
+    return path + '.wl.npy'
+
+
+def indexPath(path):
+    return path + '.idx.npy'
+
+
+def _loadRecords(path, mode='r'):
+    """memory map of the complete records of a .npy file of records"""
+    with open(path, 'rb') as f:
+        dtype, headersize = _readHeader(f)
+    rows = (os.path.getsize(path) - headersize) // dtype.itemsize
+    if rows == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode=mode, offset=headersize,
+                     shape=(rows,))
+
+
+def loadSpectra(path, mode='r'):
+    """Memory-map a spectra log as a structured array with fields time,
+    serial, inttime and spectrum. Only complete records are mapped, the
+    record count in the header is not relied upon.\n
+    * mode = 'r' (read only) or 'c' (copy on write)\n"""
+    return _loadRecords(path, mode)
+
+
+def loadIndex(path):
+    """Memory-map the index sidecar of a spectra log (fields time, serial
+    and inttime of each record). It may hold fewer records than the log
+    while a writer is flushing, and none if the log has no index."""
+    if not os.path.exists(indexPath(path)):
+        return np.zeros(0, dtype=_INDEX_DTYPE)
+    return _loadRecords(indexPath(path))
+
+
+def loadWavelengths(path):
+    """wavelength grid of a spectra log, None if not saved"""
+    if not os.path.exists(wavelengthPath(path)):
+        return None
+    return np.load(wavelengthPath(path))
+
+
+class SpectraArchive(object):
+    """Random access to a (large) spectra log by time and sensor.\n
+    The log is memory-mapped and the time and serial fields are copied, in
+    chunks, to build a time index per sensor serial number, so archives
+    much larger than the available memory can be queried. The index holds
+    16 bytes per record. It is built from the index sidecar written by
+    SpectraWriter, so opening an archive does not read the spectra;
+    records not in the sidecar (a log without one) are read from the log
+    itself. Queries only read the records they return and refresh() only
+    reads appended records.\n
+    * path = spectra log written by SpectraWriter\n
+    * chunksize = records read at a time while indexing\n
+    Times are datetimes or POSIX seconds. Call refresh() to pick up
+    records appended since the archive was opened."""
+    def __init__(self, path, chunksize=1000000):
+        self.path = path
+        self.chunksize = int(chunksize)
+        self.records = np.zeros(0, dtype=spectraDtype())
+        self.wavelengths = loadWavelengths(path)
+        self.monotonic = True  # log times never decrease
+        self._times = {}  # serial number: sorted times
+        self._rows = {}  # serial number: record numbers, same order
+        self.refresh()
+
+    def refresh(self):
+        """map and index records appended since the last refresh"""
+        start = len(self.records)
+        self.records = loadSpectra(self.path)
+        if len(self.records) == start:
+            return 0
+        lasttime = self.records['time'][start - 1] if start else -np.inf
+        index = loadIndex(self.path)
+        times, rows = {}, {}
+        for a in range(start, len(self.records), self.chunksize):
+            b = min(a + self.chunksize, len(self.records))
+            fields = index if b <= len(index) else self.records
+            t = np.array(fields['time'][a:b])
+            s = np.array(fields['serial'][a:b])
+            if t[0] < lasttime or np.any(np.diff(t) < 0):
+                self.monotonic = False
+            lasttime = t[-1]
+            for sn in np.unique(s):
+                sel = np.flatnonzero(s == sn)
+                times.setdefault(sn, []).append(t[sel])
+                rows.setdefault(sn, []).append(sel + a)
+        for sn in times:
+            key = sn.decode('ascii')
+            t = np.concatenate([self._times.get(key, [])] + times[sn])
+            r = np.concatenate([self._rows.get(key, np.zeros(0, np.int64))]
+                               + rows[sn]).astype(np.int64)
+            order = np.argsort(t, kind='stable')
+            self._times[key], self._rows[key] = t[order], r[order]
+        return len(self.records) - start
+
+    def sensors(self):
+        return sorted(self._times.keys())
+
+    def times(self, serialn):
+        """sorted record times (POSIX seconds) of a sensor"""
+        return self._times[serialn]
+
+    def rows(self, serialn, start=None, end=None):
+        """record numbers of a sensor for start <= time < end"""
+        times = self._times[serialn]
+        a, b = _bounds(times, start, end)
+        return self._rows[serialn][a:b]
+
+    def window(self, start=None, end=None):
+        """records of all sensors for start <= time < end. If the log times
+        never decrease this is a view of the memory map (zero copy)."""
+        if self.monotonic:
+            a, b = _bounds(self.records['time'], start, end)
+            return self.records[a:b]
+        rows = np.concatenate([self.rows(sn, start, end)
+                               for sn in self.sensors()] or [[]])
+        rows = rows.astype(np.int64)
+        return self.records[rows[np.argsort(self.records['time'][rows],
+                                            kind='stable')]]
+
+    def select(self, serialn, start=None, end=None):
+        """records of one sensor for start <= time < end, in time order.
+        Sensors are interleaved in the log, so these are copied."""
+        return self.records[self.rows(serialn, start, end)]
+
+    def nearest(self, serialn, timestamp):
+        """record of a sensor closest in time to *timestamp*"""
+        times = self._times[serialn]
+        t = _posix(timestamp)
+        i = np.clip(np.searchsorted(times, t), 1, len(times) - 1)
+        if len(times) == 1 or abs(times[i-1] - t) <= abs(times[i] - t):
+            i = i - 1
+        return self.records[self._rows[serialn][i]]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return "<PyTrios SpectraArchive: {0}, {1} records, sensors {2}>"\
+            .format(self.path, len(self.records), self.sensors())
+
+
+def _bounds(times, start, end):
+    """slice bounds of start <= times < end in sorted *times*"""
+    a = 0 if start is None else np.searchsorted(times, _posix(start))
+    b = len(times) if end is None else np.searchsorted(times, _posix(end))
+    return int(a), int(b)
+
+
+class AsyncSpectraWriter(object):
+    """Writes spectra on a background thread, fed by a bounded queue.\n
+    * path = output file, appended to\n
+    * fmt = 'npy' (spectra log, see SpectraWriter) or 'csv' (rows of
+    timestamp, serial number, integration time, values)\n
+    * width, dtype, wavelengths = layout of 'npy' logs\n
+    * maxqueue = records waiting to be written, when full the oldest
+    record is dropped rather than blocking the caller\n
+    * batchsize = maximum records formatted and written at once\n
+    * fsyncinterval = seconds between forcing written data to disk
+    (None = leave it to the operating system)\n
+    * valuefmt = printf format of csv values (default %d for integer
+    dtypes, %.8g otherwise)\n
+    Statistics: *depth* (records queued), *received*, *written*,
+    *dropped*, *errors*, *latency_mean* and *latency_max* (seconds per
+    batch write)."""
+    def __init__(self, path, fmt='csv', width=256, dtype=np.uint16,
+                 wavelengths=None, maxqueue=10000, batchsize=500,
+                 fsyncinterval=10.0, valuefmt=None, verbosity=1):
+        if fmt not in ('csv', 'npy'):
+            raise ValueError("unknown output format {0}".format(fmt))
+        self.path = path
+        self.fmt = fmt
+        self.batchsize = max(int(batchsize), 1)
+        self.fsyncinterval = fsyncinterval
+        self.verbosity = verbosity
+        if valuefmt is None:
+            valuefmt = '%d' if np.issubdtype(dtype, np.integer) else '%.8g'
+        self.valuefmt = valuefmt
+        if fmt == 'npy':
+            self._writer = SpectraWriter(path, width, dtype, wavelengths,
+                                         buffersize=self.batchsize,
+                                         fsync=False)
+            self._file = self._writer.f
+        else:
+            self._writer = None
+            self._file = open(path, 'a')
+        self.queue = queue.Queue(maxqueue)
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.batches = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self._lastsync = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, spectrum, timestamp, serialn, inttime=0):
+        """queue a spectrum for writing, never blocks.\n
+        *timestamp* = datetime or POSIX seconds"""
+        self.received += 1
+        self.dropped += put_drop_oldest(
+            self.queue, (spectrum, timestamp, serialn, inttime))
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    @property
+    def latency_mean(self):
+        if self.batches == 0:
+            return None
+        return self.latency_sum / self.batches
+
+    def _run(self):
+        while not (self._stop.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=0.5)]
+            except queue.Empty:
+                self._sync(force=False)
+                continue
+            while len(batch) < self.batchsize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            t0 = time.time()
+            try:
+                self._write(batch)
+                self.written += len(batch)
+                self._sync(force=False)
+            except (OSError, ValueError) as e:
+                self.errors += 1
+                if self.verbosity > 0:
+                    print("{0}: failed to write {1} spectra: {2}"
+                          .format(self.path, len(batch), e), file=sys.stderr)
+            latency = time.time() - t0
+            self.batches += 1
+            self.latency_sum += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+    def _write(self, batch):
+        spectra = np.array([b[0] for b in batch])
+        if self.fmt == 'npy':
+            records = np.zeros(len(batch), dtype=self._writer.dtype)
+            records['time'] = [_posix(b[1]) for b in batch]
+            records['serial'] = [b[2] for b in batch]
+            records['inttime'] = [b[3] for b in batch]
+            records['spectrum'] = spectra
+            self._writer.write(records)
+            self._writer.flush()
+            return
+        values = io.StringIO()
+        np.savetxt(values, np.atleast_2d(spectra), fmt=self.valuefmt,
+                   delimiter=',')
+        lines = values.getvalue().splitlines()
+        self._file.write(''.join(
+            "{0},{1},{2},{3}\n".format(_isoformat(b[1]), b[2], b[3], line)
+            for b, line in zip(batch, lines)))
+        self._file.flush()
+
+    def _sync(self, force):
+        if self.fsyncinterval is None and not force:
+            return
+        if force or time.time() - self._lastsync >= self.fsyncinterval:
+            if self._writer is not None:
+                self._writer.sync()
+            else:
+                os.fsync(self._file.fileno())
+            self._lastsync = time.time()
+
+    def close(self, timeout=None):
+        """write all queued records, then close the file"""
+        if self._file.closed:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._writer is not None:
+            self._writer.flush()
+        self._sync(force=True)
+        if self._writer is not None:
+            self._writer.close()
+        else:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return "<PyTrios AsyncSpectraWriter: {0}, {1} queued, {2} written, "\
+            .format(self.path, self.depth, self.written)\
+            + "{0} dropped, {1:.4f} s/batch>".format(self.dropped,
+                                                    self.latency_mean or 0.0)
+
+
+def _isoformat(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.isoformat()
+    return datetime.datetime.fromtimestamp(timestamp).isoformat()